@@ -0,0 +1,74 @@
+#Measures how much compressing message bodies shrinks the db, and what it
+#costs to decompress one when it's opened. Reads the bodies of an existing db:
+#    python benchmarks/compression.py [path/to/mail.db]
+import sys, os, time, zlib, sqlite3, tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "services"))
+from store import *
+
+def db_size(rows, create, insert):
+    #Returns the size in bytes of a fresh, vacuumed db holding rows
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        db = sqlite3.connect(path)
+        db.execute(create)
+        db.executemany(insert, rows)
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        return os.path.getsize(path)
+
+def decode_times(blobs, dictionary=None):
+    #Returns the seconds taken to decompress each blob
+    times = []
+    for blob in blobs:
+        start = time.perf_counter()
+        if dictionary is None:
+            zlib.decompress(blob).decode()
+        else:
+            decompressor = zlib.decompressobj(zdict=dictionary)
+            (decompressor.decompress(blob) + decompressor.flush()).decode()
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+def compress(text, dictionary=None):
+    if dictionary is None:
+        return zlib.compress(text.encode())
+    compressor = zlib.compressobj(zdict=dictionary)
+    return compressor.compress(text.encode()) + compressor.flush()
+
+def report(name, text_size, blobs, times):
+    size = sum(len(blob) for blob in blobs)
+    print(f"{name:<16} {size:>12,} bytes  ratio {text_size / max(size, 1):5.2f}"
+          + f"  decode mean {sum(times) / len(times) * 1e6:7.1f} us"
+          + f"  p95 {times[int(len(times) * 0.95)] * 1e6:7.1f} us")
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "mail.db"
+    store = Store(path, {})
+    texts = [store.body_text(*row) for row in store.db.execute("SELECT dict, data FROM bodies")]
+    store.close()
+    if not texts:
+        print("No message bodies in", path, "- sync with \"sync_mode\": \"full\" first")
+        return
+    text_size = sum(len(text.encode()) for text in texts)
+    print(len(texts), "bodies,", f"{text_size:,}", "bytes of text")
+
+    #Train on half the bodies and measure on the other half, as bodies
+    #compressed with a dictionary are ones that arrive after it was made
+    sample, rest = texts[::2], texts[1::2] or texts
+    dictionary = train_dictionary(sample[-DICT_SAMPLE_AMT:])
+    rest_size = sum(len(text.encode()) for text in rest)
+    plain_blobs = [compress(text) for text in rest]
+    dict_blobs = [compress(text, dictionary) for text in rest]
+    print("Dictionary:", len(dictionary), "bytes; measured on", len(rest), "bodies")
+    report("zlib", rest_size, plain_blobs, decode_times(plain_blobs))
+    report("zlib+dictionary", rest_size, dict_blobs, decode_times(dict_blobs, dictionary))
+
+    text_db = db_size(((text,) for text in texts), "CREATE TABLE bodies (text VARCHAR)",
+                      "INSERT INTO bodies VALUES (?)")
+    blob_db = db_size(((compress(text),) for text in texts), "CREATE TABLE bodies (data BLOB)",
+                      "INSERT INTO bodies VALUES (?)")
+    print(f"Db holding only bodies: {text_db:,} bytes as text, {blob_db:,} bytes compressed"
+          + f" ({1 - blob_db / text_db:.0%} smaller)")
+
+main()
@@ -0,0 +1,447 @@
+#A small IMAP4rev1 server serving synthetic mailboxes, so syncing can be
+#measured (see benchmarks/syncing.py) without a real account. It runs in the
+#calling process, on its own threads:
+#    server = FakeIMAPServer([Mailbox("INBOX", 10_000, mix=("text", "html"))])
+#    MailService({"host": "127.0.0.1", "port": server.port, "ssl": False, ...})
+#Messages are made from their number whenever they're fetched, so even a
+#million-message mailbox takes little memory
+import socketserver, threading, random, re, time, bisect, select, email.utils, zlib
+
+#Words message bodies are made of; the URL is completed per message
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "mail", "sync", "thread",
+         "invoice", "meeting", "https://example.com/p/"]
+#Distinct bodies per mailbox; messages reuse them, so making one is cheap
+BODY_AMT = 64
+#Lines of base64 in each attachment (76 chars each, about 150KB)
+ATTACHMENT_LINES = 2000
+#Kinds of message a mailbox's MIME mix can contain
+KINDS = ("text", "html", "attachment")
+#Every (date of) message n is n hours after this
+EPOCH = 1_500_000_000
+
+def make_bodies(seed):
+    rnd = random.Random(seed)
+    return ["\n".join(" ".join(rnd.choice(WORDS) for _ in range(12)) for _ in range(20))
+            for _ in range(BODY_AMT)]
+
+def text_structure(subtype, data):
+    lines = data.count(b"\n")
+    return f'("TEXT" "{subtype}" ("CHARSET" "UTF-8") NIL NIL "7BIT" {len(data)} {lines})'
+
+class Message:
+    """Purpose: Synthetic message number n of the given kind: its raw bytes,
+        BODYSTRUCTURE and body sections, as a server reports them. Every
+        fifth message starts a thread the next four reply to"""
+    def __init__(self, n, kind, body):
+        body = body.replace("https://example.com/p/", f"https://example.com/p/{n}")
+        self.headers = [("From", f"Sender {n % 50} <sender{n % 50}@example.com>"),
+                        ("To", "me@example.com"),
+                        ("Subject", f"Message {n} about {WORDS[n % 10]}"),
+                        ("Date", email.utils.formatdate(EPOCH + n * 3600)),
+                        ("Message-ID", f"<msg{n}@example.com>")]
+        if n % 5:
+            self.headers.append(("In-Reply-To", f"<msg{n - n % 5}@example.com>"))
+        self.headers.append(("MIME-Version", "1.0"))
+        plain = body.replace("\n", "\r\n").encode() + b"\r\n"
+        html = ("<html><body>" + "".join(f'<p>{line} <a href="https://example.com/{n}">link</a></p>'
+                                         for line in body.split("\n"))
+                + "</body></html>\r\n").encode()
+        if kind == "text":
+            content_type = "text/plain; charset=utf-8"
+            text = plain
+            self.structure = text_structure("PLAIN", plain)
+            self.sections = {"1": plain}
+        elif kind == "html":
+            content_type = "text/html; charset=utf-8"
+            text = html
+            self.structure = text_structure("HTML", html)
+            self.sections = {"1": html}
+        else:
+            content_type = 'multipart/mixed; boundary="b1"'
+            attachment = ("QUJD" * 19 + "\r\n").encode() * ATTACHMENT_LINES
+            alternative = (b"--b2\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n" + plain
+                           + b"--b2\r\nContent-Type: text/html; charset=utf-8\r\n\r\n" + html
+                           + b"--b2--\r\n")
+            text = (b'--b1\r\nContent-Type: multipart/alternative; boundary="b2"\r\n\r\n'
+                    + alternative + b"--b1\r\nContent-Type: application/octet-stream\r\n"
+                    + b"Content-Transfer-Encoding: base64\r\n\r\n" + attachment + b"--b1--\r\n")
+            self.structure = ("((" + text_structure("PLAIN", plain) + text_structure("HTML", html)
+                              + ' "ALTERNATIVE")("APPLICATION" "OCTET-STREAM" NIL NIL NIL'
+                              + f' "BASE64" {len(attachment)}) "MIXED")')
+            self.sections = {"1": alternative, "1.1": plain, "1.2": html, "2": attachment}
+        self.headers.append(("Content-Type", content_type))
+        self.header = "".join(f"{key}: {value}\r\n" for key, value in self.headers).encode() + b"\r\n"
+        self.sections["HEADER"] = self.header
+        self.sections["TEXT"] = text
+        self.raw = self.header + text
+
+    def header_fields(self, names):
+        wanted = {name.lower() for name in names}
+        return "".join(f"{key}: {value}\r\n" for key, value in self.headers
+                       if key.lower() in wanted).encode() + b"\r\n"
+
+class Mailbox:
+    """Purpose: A mailbox of size synthetic messages, cycling through the kinds
+        in mix. Only UIDs and mod-sequences are kept; messages are made from
+        their number when fetched"""
+    def __init__(self, name, size=0, mix=("text",), seed=0):
+        self.name = name
+        self.mix = mix
+        self.bodies = make_bodies(seed)
+        self.uidvalidity = 1
+        #Sorted UIDs of the messages, and the mod-sequence of each
+        self.uids = list(range(1, size + 1))
+        self.modseqs = [1] * size
+        self.modseq = 1
+        #Messages added with add(), by UID; others are made from their UID
+        self.added = {}
+        #UIDs of messages marked \Seen
+        self.seen = set()
+        #(UID, mod-sequence) of expunged messages, for QRESYNC
+        self.vanished = []
+        self.next_uid = size + 1
+
+    def message(self, uid):
+        if uid in self.added:
+            return self.added[uid]
+        n = uid - 1
+        return Message(n, self.mix[n % len(self.mix)], self.bodies[n % BODY_AMT])
+
+    def add(self, kind="text"):
+        #Delivers a new message; returns its UID
+        self.modseq += 1
+        uid = self.next_uid
+        self.next_uid += 1
+        self.added[uid] = Message(uid - 1, kind, self.bodies[(uid - 1) % BODY_AMT])
+        self.uids.append(uid)
+        self.modseqs.append(self.modseq)
+        return uid
+
+    def expunge(self, uid):
+        i = bisect.bisect_left(self.uids, uid)
+        if i < len(self.uids) and self.uids[i] == uid:
+            self.modseq += 1
+            del self.uids[i], self.modseqs[i]
+            self.vanished.append((uid, self.modseq))
+
+def parse_set(text, largest):
+    #Returns the (first, last) ranges of an IMAP sequence set such as
+    #'1:5,9,12:*', sorted and merged
+    ranges = []
+    for part in text.split(","):
+        first, _, last = part.partition(":")
+        first = largest if first == "*" else int(first)
+        last = first if not last else largest if last == "*" else int(last)
+        ranges.append((min(first, last), max(first, last)))
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def tokenize(text):
+    #Splits a command's arguments, keeping quoted strings, parenthesized
+    #lists and bracketed sections whole
+    return re.findall(r'"(?:[^"\\]|\\.)*"|\((?:[^()]|\([^()]*\))*\)'
+                      + r'|[^\s\[\]]*\[[^\]]*\](?:<[\d.]+>)?|\S+', text)
+
+def quote(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+class Handler(socketserver.StreamRequestHandler):
+    """Purpose: Serves one client connection, one command at a time"""
+    #Unbuffered, so select() shows whether a client line is waiting during IDLE
+    rbufsize = 0
+    #Responses are written in pieces; with Nagle's algorithm, each command
+    #would wait out the client's delayed ACK (about 40ms)
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.state = self.server.state
+        self.selected = None
+        self.enabled = set()
+        #Raw deflate streams each way once COMPRESS DEFLATE succeeds, and
+        #inflated bytes not read yet
+        self.compressor = None
+        self.decompressor = None
+        self.inflated = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.state.bytes_out += len(data)
+
+    def fill(self):
+        #Inflates more of the client's stream; returns False at EOF
+        data = self.request.recv(65536)
+        self.state.bytes_in += len(data)
+        self.inflated += self.decompressor.decompress(data)
+        return bool(data)
+
+    def readline(self):
+        if self.decompressor is None:
+            line = self.rfile.readline()
+            self.state.bytes_in += len(line)
+            return line
+        while b"\n" not in self.inflated:
+            if not self.fill():
+                return b""
+        end = self.inflated.index(b"\n") + 1
+        line = bytes(self.inflated[:end])
+        del self.inflated[:end]
+        return line
+
+    def read(self, size):
+        if self.decompressor is None:
+            data = self.rfile.read(size)
+            self.state.bytes_in += len(data)
+            return data
+        while len(self.inflated) < size and self.fill():
+            pass
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def handle(self):
+        self.write("* OK [CAPABILITY " + self.server.capabilities + "] fake IMAP ready\r\n")
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+            #Read any literals (e.g. a LOGIN password) into the line, quoted
+            while re.search(r'\{(\d+)\}$', line):
+                size = int(re.search(r'\{(\d+)\}$', line).group(1))
+                self.write("+ Ready\r\n")
+                literal = self.read(size).decode()
+                line = line[:line.rindex("{")] + quote(literal) + self.readline().decode().rstrip("\r\n")
+            tag, _, rest = line.partition(" ")
+            command, _, args = rest.partition(" ")
+            self.state.commands += 1
+            method = getattr(self, "do_" + command.upper(), None)
+            if method is None:
+                self.write(f"{tag} BAD unknown command\r\n")
+                continue
+            if self.state.latency:
+                #Simulates the round trip to a distant server
+                time.sleep(self.state.latency)
+            with self.state.lock:
+                if method(tag, args) == "LOGOUT":
+                    return
+
+    def ok(self, tag, text="completed"):
+        self.write(f"{tag} OK {text}\r\n")
+
+    def do_CAPABILITY(self, tag, args):
+        self.write("* CAPABILITY " + self.server.capabilities + "\r\n")
+        self.ok(tag)
+
+    def do_LOGIN(self, tag, args):
+        self.ok(tag, "[CAPABILITY " + self.server.capabilities + "] authenticated")
+
+    def do_LOGOUT(self, tag, args):
+        self.write("* BYE logging out\r\n")
+        self.ok(tag)
+        return "LOGOUT"
+
+    def do_NOOP(self, tag, args):
+        self.ok(tag)
+
+    def do_COMPRESS(self, tag, args):
+        if args.upper() != "DEFLATE" or "COMPRESS=DEFLATE" not in self.server.capabilities:
+            self.write(f"{tag} BAD unsupported compression\r\n")
+        elif self.compressor is not None:
+            self.write(f"{tag} NO [COMPRESSIONACTIVE] already compressing\r\n")
+        else:
+            self.ok(tag, "DEFLATE active")
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            self.decompressor = zlib.decompressobj(-15)
+
+    def do_ENABLE(self, tag, args):
+        self.enabled.update(args.upper().split())
+        self.write("* ENABLED " + args + "\r\n")
+        self.ok(tag)
+
+    def do_LIST(self, tag, args):
+        for name in self.state.mailboxes:
+            self.write(f'* LIST (\\HasNoChildren) "/" {quote(name)}\r\n')
+        self.ok(tag)
+
+    def do_SELECT(self, tag, args):
+        name = tokenize(args)[0].strip('"')
+        box = self.state.mailboxes.get(name)
+        if box is None:
+            self.write(f"{tag} NO [NONEXISTENT] Unknown Mailbox: {name}\r\n")
+            return
+        self.selected = box
+        #UIDs this connection has been told about; IDLE reports differences
+        self.view = list(box.uids)
+        self.write(f"* FLAGS (\\Seen)\r\n* {len(box.uids)} EXISTS\r\n* 0 RECENT\r\n"
+                   + f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid\r\n"
+                   + f"* OK [UIDNEXT {box.next_uid}] Predicted next UID\r\n")
+        if "CONDSTORE" in self.server.capabilities:
+            self.write(f"* OK [HIGHESTMODSEQ {box.modseq}] Highest\r\n")
+        self.ok(tag, "[READ-WRITE] selected")
+    do_EXAMINE = do_SELECT
+
+    def do_IDLE(self, tag, args):
+        self.write("+ idling\r\n")
+        #Other connections may change mailboxes meanwhile
+        self.state.lock.release()
+        try:
+            while True:
+                readable, _, _ = select.select([self.request], [], [], 0.05)
+                if readable or self.inflated:
+                    self.readline()
+                    break
+                with self.state.lock:
+                    self.notify()
+        finally:
+            self.state.lock.acquire()
+        self.ok(tag)
+
+    def notify(self):
+        #Tells the client about messages added/expunged since it last looked
+        box = self.selected
+        current = set(box.uids)
+        gone = [uid for uid in self.view if uid not in current]
+        if gone and "QRESYNC" in self.enabled:
+            self.write("* VANISHED " + ",".join(map(str, gone)) + "\r\n")
+            self.view = [uid for uid in self.view if uid in current]
+        else:
+            for uid in gone:
+                self.write(f"* {self.view.index(uid) + 1} EXPUNGE\r\n")
+                self.view.remove(uid)
+        if len(box.uids) > len(self.view):
+            self.view = list(box.uids)
+            self.write(f"* {len(box.uids)} EXISTS\r\n")
+
+    def do_UID(self, tag, args):
+        command, _, args = args.partition(" ")
+        if command.upper() == "SEARCH":
+            return self.search(tag, args, by_uid=True)
+        if command.upper() == "FETCH":
+            return self.fetch(tag, args, by_uid=True)
+        self.write(f"{tag} BAD unsupported\r\n")
+
+    def do_SEARCH(self, tag, args):
+        return self.search(tag, args, by_uid=False)
+
+    def do_FETCH(self, tag, args):
+        return self.fetch(tag, args, by_uid=False)
+
+    def indexes(self, sequence_set, by_uid):
+        #Yields the index in the selected mailbox of each message in the set
+        box = self.selected
+        largest = (box.uids[-1] if box.uids else 0) if by_uid else len(box.uids)
+        for first, last in parse_set(sequence_set, largest):
+            if by_uid:
+                yield from range(bisect.bisect_left(box.uids, first),
+                                 bisect.bisect_right(box.uids, last))
+            else:
+                yield from range(max(first, 1) - 1, min(last, len(box.uids)))
+
+    def search(self, tag, args, by_uid):
+        #Supports ALL and UID <set>
+        tokens = args.split()
+        if tokens and tokens[0].upper() == "UID":
+            found = self.indexes(tokens[1], True)
+        else:
+            found = range(len(self.selected.uids))
+        numbers = (self.selected.uids[i] if by_uid else i + 1 for i in found)
+        self.write("* SEARCH " + " ".join(map(str, numbers)) + "\r\n")
+        self.ok(tag)
+
+    def fetch(self, tag, args, by_uid):
+        box = self.selected
+        tokens = tokenize(args)
+        sequence_set, items = tokens[0], tokens[1]
+        modifiers = tokens[2].strip("()").upper().split() if len(tokens) > 2 else []
+        items = tokenize(items[1:-1] if items.startswith("(") else items)
+        if by_uid and "UID" not in [item.upper() for item in items]:
+            items = ["UID"] + items
+        changedsince = None
+        if "CHANGEDSINCE" in modifiers:
+            changedsince = int(modifiers[modifiers.index("CHANGEDSINCE") + 1])
+            if "VANISHED" in modifiers:
+                ranges = parse_set(sequence_set, box.next_uid)
+                vanished = [uid for uid, modseq in box.vanished if modseq > changedsince
+                            and any(first <= uid <= last for first, last in ranges)]
+                if vanished:
+                    self.write("* VANISHED (EARLIER) " + ",".join(map(str, vanished)) + "\r\n")
+        for i in self.indexes(sequence_set, by_uid):
+            uid, modseq = box.uids[i], box.modseqs[i]
+            if changedsince is not None and modseq <= changedsince:
+                continue
+            msg = None
+            fields = []
+            for item in items:
+                name = item.upper()
+                if name == "UID":
+                    fields.append(f"UID {uid}".encode())
+                elif name == "FLAGS":
+                    fields.append(b"FLAGS (\\Seen)" if uid in box.seen else b"FLAGS ()")
+                elif name == "MODSEQ":
+                    fields.append(f"MODSEQ ({modseq})".encode())
+                elif name == "INTERNALDATE":
+                    date = time.strftime("%d-%b-%Y %H:%M:%S +0000",
+                                         time.gmtime(EPOCH + (uid - 1) * 3600))
+                    fields.append(f'INTERNALDATE "{date}"'.encode())
+                else:
+                    msg = msg or box.message(uid)
+                    if name == "RFC822.SIZE":
+                        fields.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+                    elif name == "BODYSTRUCTURE":
+                        fields.append(b"BODYSTRUCTURE " + msg.structure.encode())
+                    elif name == "RFC822" or name.startswith("BODY"):
+                        section = re.search(r'\[(.*)\]', item).group(1) if "[" in item else ""
+                        if name == "RFC822" or not section:
+                            data = msg.raw
+                        elif section.upper().startswith("HEADER.FIELDS"):
+                            data = msg.header_fields(re.search(r'\((.*)\)', section).group(1).split())
+                        else:
+                            data = msg.sections.get(section.upper(), b"")
+                        if ".PEEK" not in name:
+                            box.seen.add(uid)
+                        label = "RFC822" if name == "RFC822" else f"BODY[{section}]"
+                        fields.append(f"{label} {{{len(data)}}}\r\n".encode() + data)
+            if changedsince is not None and "MODSEQ" not in [item.upper() for item in items]:
+                fields.append(f"MODSEQ ({modseq})".encode())
+            self.write(f"* {i + 1} FETCH (".encode() + b" ".join(fields) + b")\r\n")
+        self.ok(tag)
+
+class ServerState:
+    """Purpose: The mailboxes a FakeIMAPServer serves, and counters of its traffic"""
+    def __init__(self, mailboxes):
+        self.mailboxes = {box.name: box for box in mailboxes}
+        #Held while a command runs, and by callers changing mailboxes
+        self.lock = threading.RLock()
+        #Commands received (i.e. round trips), and bytes received/sent
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        #Seconds each command is delayed by
+        self.latency = 0
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Purpose: Serves mailboxes over plain-text IMAP on a free localhost port,
+        one thread per connection"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailboxes,
+                 capabilities="IMAP4rev1 CONDSTORE QRESYNC ENABLE IDLE COMPRESS=DEFLATE"):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.state = ServerState(mailboxes)
+        self.capabilities = capabilities
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
@@ -0,0 +1,150 @@
+#Measures syncing and browsing a mailbox against the fake IMAP server in
+#benchmarks/fake_imap.py, so no real account is needed. Prints JSON results
+#(to compare between versions, e.g. with diff) on stdout:
+#    python benchmarks/syncing.py --sizes 1000,10000 --mix text,html,attachment
+#Each size runs in its own process, so peak RSS (which includes the fake
+#server) is per size. The mailbox view is only measured if Tk can open a
+#display; its window stays hidden
+import sys, os, time, json, queue, argparse, resource, subprocess, tempfile, contextlib
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "services"))
+from fake_imap import *
+from imap import *
+from store import *
+from sync import *
+
+#Number of threads opened when measuring the mailbox view
+THREADS_OPENED = 20
+
+class Counters:
+    """Purpose: Measures what a phase of the benchmark cost: time, round trips,
+        bytes transferred and peak RSS"""
+    def __init__(self, server):
+        self.state = server.state
+        self.results = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, msg_amt):
+        #Records the cost of the with block, which handles msg_amt messages
+        commands, bytes_in, bytes_out = (self.state.commands, self.state.bytes_in,
+                                         self.state.bytes_out)
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            "seconds": round(seconds, 4),
+            "msgs": msg_amt,
+            "msgs_per_sec": round(msg_amt / seconds, 1) if seconds else None,
+            "round_trips": self.state.commands - commands,
+            "bytes_sent": self.state.bytes_in - bytes_in,
+            "bytes_received": self.state.bytes_out - bytes_out,
+            #Kilobytes on Linux; the peak so far, so it only grows
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+def bench_view(counters, config, size):
+    #Lists and opens threads like the UI would, without showing a window.
+    #Returns why it was skipped, or None
+    import mail
+    try:
+        root = mail.Tk()
+    except mail.TclError as e:
+        return str(e)
+    root.withdraw()
+    service = MailService(config)
+    store = Store("mail.db", config)
+    controller = mail.MailboxController(root, service, "INBOX", store, Prefetcher(config))
+    with counters.phase("show_subjects", mail.PAGE_SIZE):
+        controller.show_subjects()
+        root.update()
+    pages = min(size // mail.PAGE_SIZE, 10)
+    with counters.phase("scroll", pages * mail.PAGE_SIZE):
+        for _ in range(pages):
+            controller.list_view.load_more(True)
+            root.update()
+    thread_ids = controller.list_view.ids[:THREADS_OPENED]
+    #Bodies are downloaded as threads are opened (unless already synced), on
+    #the prefetcher's thread; waiting for it is part of opening a thread
+    with counters.phase("open_threads", len(thread_ids)):
+        for thread_id in thread_ids:
+            controller.prefetcher.submit("INBOX", [thread_id]).result()
+            controller.msg_view.show(controller.load_thread(thread_id))
+            root.update()
+    controller.thread_cache.clear()
+    with counters.phase("reopen_threads", len(thread_ids)):
+        for thread_id in thread_ids:
+            controller.msg_view.show(controller.load_thread(thread_id))
+            root.update()
+    store.close()
+    root.destroy()
+    return None
+
+def run(args):
+    #Benchmarks one mailbox size; returns its results
+    mailbox = Mailbox("INBOX", args.size, mix=tuple(args.mix.split(",")))
+    capabilities = ("IMAP4rev1 ENABLE IDLE" + ("" if args.no_qresync else " CONDSTORE QRESYNC")
+                    + ("" if args.no_compress else " COMPRESS=DEFLATE"))
+    server = FakeIMAPServer([mailbox], capabilities)
+    server.state.latency = args.latency_ms / 1000
+    config = {"host": "127.0.0.1", "port": server.port, "ssl": False,
+              "username": "bench", "password": "bench", "sync_mode": args.mode,
+              "connections": args.connections}
+    counters = Counters(server)
+    store = Store("mail.db", config)
+    pool = ServicePool(args.connections, config)
+    sync = MailboxSync(pool.get(), store, "INBOX", queue.Queue(), pool)
+    with counters.phase("build_db", args.size):
+        sync.sync()
+    with counters.phase("refresh_db_unchanged", 0):
+        sync.sync()
+    #1% of messages arrive and 1% are deleted between syncs
+    changed = max(args.size // 100, 1)
+    with server.state.lock:
+        for uid in mailbox.uids[:changed]:
+            mailbox.expunge(uid)
+        for _ in range(changed):
+            mailbox.add()
+    with counters.phase("refresh_db_changed", changed * 2):
+        sync.sync()
+    store.close()
+    skipped = bench_view(counters, config, args.size)
+    return {"size": args.size, "mix": args.mix, "mode": args.mode,
+            "connections": args.connections, "latency_ms": args.latency_ms,
+            "qresync": not args.no_qresync, "compress": not args.no_compress,
+            "db_bytes": os.path.getsize("mail.db"),
+            "view_skipped": skipped, "phases": counters.results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks syncing against a fake IMAP server")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma-separated mailbox sizes to run, e.g. 1000,100000,1000000")
+    parser.add_argument("--mix", default="text,html,attachment",
+                        help="kinds of message the mailbox cycles through: " + ",".join(KINDS))
+    parser.add_argument("--mode", default="headers", choices=["headers", "full", "archive"],
+                        help="sync_mode to sync with")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="delay added to every command, like a distant server's")
+    parser.add_argument("--no-qresync", action="store_true",
+                        help="make the server lack CONDSTORE/QRESYNC")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="make the server lack COMPRESS=DEFLATE")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.size is not None:
+        #Child process running one size, in a scratch directory
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            #The app's own output would mix with the JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                results = run(args)
+        print(json.dumps(results))
+        return
+    results = []
+    for size in args.sizes.split(","):
+        command = [sys.executable, __file__, "--size", size] + sys.argv[1:]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+        results.append(json.loads(output))
+    print(json.dumps(results, indent=2))
+
+main()
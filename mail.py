@@ -3,17 +3,22 @@
 # [X] Figure out how/when to batch IMAP requests
 # [ ] Work on performance/organizing code
 # [X] Finish implementing mailbox syncing
-# [ ] Add support for multiple mailboxes, shown in sidebar
-# [ ] Have db contain messages from all labels
+# [X] Add support for multiple mailboxes, shown in sidebar
+# [X] Have db contain messages from all labels
 # [ ] Unite SQL config table with config.json
 # [ ] Determine if SSL is properly implemented/secure
 # [X] Change MailService.is_synced() to sync_status, returning
 #     info about if synced (if not, say how many messages added/deleted)
-# [ ] Add code for switching MailboxControllers; make sure to disable
+# [X] Add code for switching MailboxControllers; make sure to disable
 #     trace_add() bindings for inactive controllers
-import os, sqlite3, json, re, webbrowser, sys, _tkinter
+import os, sqlite3, json, re, webbrowser, sys, _tkinter, queue, time, bisect, collections
+import argparse
 sys.path.append("services")
 from imap import *
+from store import *
+from sync import *
+from render import *
+from outbox import *
 from tkinter import *
 from tkinter import ttk, messagebox
 
@@ -22,6 +27,34 @@ if sys.platform == "darwin":
 else:
     LINK_CURSOR = "hand1"
 
+#Milliseconds between checks for updates posted by background workers
+POLL_INTERVAL = 100
+#Number of rows added to the message list each time the user scrolls near its edge
+PAGE_SIZE = 100
+#Max number of rows loaded into the message list at once
+MAX_LISTED = 500
+#HTML bodies longer than this (in characters) are rendered in the background
+RENDER_INLINE_SIZE = 100_000
+#Milliseconds the selected row must stay selected before its thread is shown
+SELECT_DELAY = 80
+#Number of threads above and below the selected one loaded ahead of time
+PREFETCH_AMT = 5
+#Max number of loaded threads kept in memory per mailbox
+THREAD_CACHE_SIZE = 50
+#Shown in place of bodies being downloaded, or that couldn't be
+DOWNLOADING_TEXT = "(Downloading...)"
+DOWNLOAD_FAILED_TEXT = "Error: couldn't download this message; select it again to retry"
+#Milliseconds between refreshes of the --stats window
+STATS_INTERVAL = 1000
+
+#Characters outside the Basic Multilingual Plane, which Tk can't display
+NON_BMP = re.compile("[^\u0000-\uffff]")
+
+def displayable(text):
+    #Replaces characters Tk can't display one-for-one, so offsets into
+    #text (e.g. of links) stay valid
+    return NON_BMP.sub("\ufffd", text)
+
 def safe_insert(widget, coords, content, tags=tuple()):
     #Acts like TextWidget.insert(), but ensures that only characters
     #which Tk can display are in the inserted string
@@ -41,144 +74,380 @@ def safe_insert(widget, coords, content, tags=tuple()):
         print("Warning: '" + content + "' has undisplayable chars in it")
 
 class MailboxView:
-    """Purpose: Show an interactive list of all messages in a mailbox"""
-    def __init__(self, parent):
+    """Purpose: Show an interactive list of all messages in a mailbox. Only a
+        window of at most MAX_LISTED rows is loaded; more are loaded on scroll"""
+    def __init__(self, parent, load_rows):
         self.parent = parent
-        #The large widget listing subjects of all messages in mailbox
-        self.widget = Listbox(self.parent, width=100, height=25)
+        #Callback returning the page of rows after (or before) a given row key
+        self.load_rows = load_rows
+        #Text typed into the search box; only matching messages are listed
+        self.query = StringVar()
+        Entry(self.parent, textvariable=self.query).pack(fill=X)
+        frame = Frame(self.parent)
+        frame.pack(fill=BOTH, expand=1)
+        self.scrollbar = Scrollbar(frame)
+        self.scrollbar.pack(side=RIGHT, fill=Y)
+        #The large widget listing subjects of messages in mailbox
+        self.widget = Listbox(frame, width=100, height=25, yscrollcommand=self.on_scroll)
         self.widget.pack(fill=BOTH, expand=1)
-        #The list of db primary keys for emails onscreen; index is result of curselection
+        self.scrollbar.config(command=self.widget.yview)
+        #The list of db primary keys for threads onscreen; index is result of curselection
         self.ids = []
+        #Sort key of each listed row; the first/last are where paging resumes
+        self.keys = []
+        #Whether the window reaches the first/last row of the whole list
+        self.at_start = self.at_end = True
+        self.load_pending = False
+        #after() id of the selection change waiting out SELECT_DELAY, if any
+        self.select_pending = None
         self.widget.bind("<<ListboxSelect>>", self.switch_current_msg)
         #The index of the currently-selected email; switch_current_msg called when changed
         self.current_msg = IntVar(value=0)
 
     def switch_current_msg(self, event):
+        #Waits for the selection to settle, so holding an arrow key only
+        #opens the thread it stops on
+        if self.select_pending is not None:
+            self.widget.after_cancel(self.select_pending)
+        self.select_pending = self.widget.after(SELECT_DELAY, self.select_current)
+
+    def select_current(self):
         #This function implicitly calls MailboxController.switch_msg_view() by
         #updating self.current_msg
+        self.select_pending = None
         #curselection() gives list of selected thread titles; just take 1
-        self.current_msg.set(self.widget.curselection()[0])
+        selection = self.widget.curselection()
+        if selection:
+            self.current_msg.set(selection[0])
+
+    def reset(self):
+        #Empties the list, then loads its first page
+        self.widget.delete(0, "end")
+        self.ids, self.keys = [], []
+        self.at_start, self.at_end = True, False
+        self.load_more(older=True)
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        #Load the next page once the user nears either edge of the window
+        if not self.load_pending:
+            if float(last) > 0.9 and not self.at_end:
+                self.load_pending = True
+                self.widget.after_idle(self.load_more, True)
+            elif float(first) < 0.1 and not self.at_start:
+                self.load_pending = True
+                self.widget.after_idle(self.load_more, False)
+
+    def load_more(self, older):
+        #Adds a page of rows past the bottom (older) or top of the window,
+        #dropping rows from the other end so the window stays small
+        self.load_pending = False
+        top = self.widget.nearest(0)
+        selection = self.widget.curselection()
+        selected = (self.keys[selection[0]], self.ids[selection[0]]) if selection else None
+        if older:
+            rows = self.load_rows(self.keys[-1] if self.keys else None, True)
+            self.at_end = len(rows) < PAGE_SIZE
+        else:
+            rows = self.load_rows(self.keys[0], False)
+            self.at_start = len(rows) < PAGE_SIZE
+        if older:
+            for key, id_, subject in rows:
+                #Insert with small margin on left
+                safe_insert(self.widget, "end", "  "+subject)
+            self.keys += [row[0] for row in rows]
+            self.ids += [row[1] for row in rows]
+            excess = len(self.ids) - MAX_LISTED
+            if excess > 0:
+                self.widget.delete(0, excess-1)
+                del self.keys[:excess], self.ids[:excess]
+                self.at_start = False
+                self.widget.yview(max(top - excess, 0))
+        else:
+            for key, id_, subject in reversed(rows):
+                safe_insert(self.widget, 0, "  "+subject)
+            self.keys[:0] = [row[0] for row in rows]
+            self.ids[:0] = [row[1] for row in rows]
+            top += len(rows)
+            if not search_query(self.query.get()):
+                #A thread listed again (e.g. it got new mail) loses its old row
+                new_ids = {row[1] for row in rows}
+                for i in reversed(range(len(rows), len(self.ids))):
+                    if self.ids[i] in new_ids:
+                        self.widget.delete(i)
+                        del self.keys[i], self.ids[i]
+                        if i < top:
+                            top -= 1
+            excess = len(self.ids) - MAX_LISTED
+            if excess > 0:
+                self.widget.delete(MAX_LISTED, "end")
+                del self.keys[MAX_LISTED:], self.ids[MAX_LISTED:]
+                self.at_end = False
+            #Keep the same rows onscreen
+            self.widget.yview(top)
+        if selected is not None:
+            self.reselect(*selected)
+
+    def reselect(self, key, id_):
+        #Selects the row that was selected before rows were added/dropped
+        #(found by key, or by id if its thread moved), keeping current_msg
+        #pointing at it
+        if key in self.keys:
+            index = self.keys.index(key)
+        elif id_ in self.ids:
+            index = self.ids.index(id_)
+        else:
+            return
+        self.widget.selection_clear(0, "end")
+        self.widget.selection_set(index)
+        if index != self.current_msg.get():
+            self.current_msg.set(index)
 
 class MailboxController:
-    """Purpose: Show an interactive list of all messages in a mailbox"""
-    def __init__(self, parent, service, label, db_cursor):
-        #The Tk object that all widgets in this object are children of
-        self.parent = parent
+    """Purpose: Show an interactive list of all threads in a mailbox"""
+    def __init__(self, parent, service, label, store, prefetcher):
+        #The Frame that all widgets in this object are children of; hidden
+        #(but kept, with its loaded rows) while another mailbox is shown
+        self.parent = Frame(parent)
         #The email service protocol object (e.g. for IMAP) used to get/send emails
         self.service = service
         #The mailbox name on the server
         self.label = label
         #The local database file used to store emails/other data
-        self.db_cursor = db_cursor
+        self.store = store
+        self.db_cursor = store.cursor
         #The large widget listing subjects of all messages in mailbox
-        self.list_view = MailboxView(self.parent)
+        self.list_view = MailboxView(self.parent, self.load_rows)
         #The text widget for displaying individual messages
         self.msg_view = MessageView(self.parent)
-        #Need to check if db has data before trying to display messages
-        try:
-            self.db_cursor.execute("SELECT id FROM messages WHERE label = ? LIMIT 1",
-                                   (self.label,))
-        except sqlite3.OperationalError:
-            self.db_cursor.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, UID INT,"
-                                   + " label VARCHAR, date INT, sender VARCHAR,"
-                                   + " recipient VARCHAR, subject VARCHAR,"
-                                   + " type VARCHAR, message_text VARCHAR)")
-            self.db_cursor.execute("CREATE TABLE drafts (id INTEGER PRIMARY KEY,"
-                                   + " recipient VARCHAR, subject VARCHAR,"
-                                   + " message_text VARCHAR)")
-            self.db_cursor.execute("CREATE TABLE config (key VARCHAR, value INT)")
-            self.db_cursor.execute("SELECT id FROM messages LIMIT 1")
-        if not self.db_cursor.fetchone():
-            self.build_db()
-        else:
-            self.refresh_db()
-
+        #Renders large HTML bodies in the background, one at a time
+        self.renderer = ThreadPoolExecutor(1)
+        #Downloads/renders threads near the selected one (see prefetch())
+        self.prefetcher = prefetcher
+        self.prefetching = False
+        #Messages of recently shown/prefetched threads, as MessageView.show()
+        #takes them, by thread id; least recently used first
+        self.thread_cache = collections.OrderedDict()
+        #Thread shown in msg_view, if any
+        self.shown_thread = None
+        #Messages are synced by a SyncWorker thread; this shows what's in the db,
+        #then updates as the worker posts changes (see db_changed())
         #Switch displayed message when user clicks on subject in ListBox
         self.list_view.current_msg.trace_add("write", self.switch_msg_view)
+        #Filter the list as the user types in the search box
+        self.list_view.query.trace_add("write", lambda name, i, mode: self.show_subjects())
         #Place subjects of each message into the Listbox widget
         self.show_subjects()
 
-    def create_msg(self, msg):
-        #Callback passed to MailService.show_msgs(); adds new msgs to database
-        self.db_cursor.execute("INSERT INTO messages (uid, label, date, sender, recipient,"
-                               + " subject, type, message_text) VALUES (?,?,?,?,?,?,?,?)",
-                               (msg["uid"], self.label, msg["internalDate"], msg["from"],
-                                msg["to"], msg["subject"], msg["type"], msg["text"]))
-
-    def build_db(self):
-        #Adds all messages from current mailbox to db
-        self.last_uid, self.msg_amt = self.service.show_msgs(self.label, "ALL",
-                                                             self.create_msg)
-        self.db_cursor.execute("INSERT INTO config VALUES (?,?)", ("last_uid_"+self.label,
-                                                                   self.last_uid))
-        self.db_cursor.execute("INSERT INTO config VALUES (?,?)", ("msg_amt_"+self.label,
-                                                                   self.msg_amt))
-
-    def add_updated_msg(self, msg):
-        #Callback passed to MailService.show_msgs(); adds only new msgs to db
-        if not self.db_cursor.execute("SELECT id FROM messages WHERE uid = ?",
-                                      (msg["uid"],)).fetchone():
-            print("Added", msg["uid"])
-            self.create_msg(msg)
-        else:
-            #Do not re-add duplicate messages
-            print("Database already has", msg["uid"])
-
-    def refresh_db(self):
-        #Updates database with changes since last sync
-        print("Database not rebuilt")
-        (self.last_uid,) = self.db_cursor.execute("SELECT value FROM config WHERE key = ?",
-                                               ("last_uid_"+self.label,)).fetchone()
-        (self.msg_amt,) = self.db_cursor.execute("SELECT value FROM config WHERE key = ?",
-                                              ("msg_amt_"+self.label,)).fetchone()
-        is_synced, server_msg_amt, new_msgs = self.service.sync_status(self.label,
-                                                                       self.last_uid,
-                                                                       self.msg_amt)
-        if is_synced and not new_msgs:
-            print("Database is synced with server")
+    def show(self):
+        self.parent.pack(fill=BOTH, expand=1)
+
+    def hide(self):
+        self.parent.pack_forget()
+
+    def db_changed(self):
+        #Called when a background sync has committed changes to this mailbox
+        self.thread_cache.clear()
+        if not self.list_view.ids:
+            self.show_subjects()
+        elif self.list_view.at_start:
+            #New messages are added at the top; the selection and the rows
+            #onscreen stay as they were, unless the list was scrolled to the
+            #top and the new rows all fit (so scrolling doesn't load more)
+            at_top = self.list_view.widget.nearest(0) == 0
+            self.list_view.load_more(older=False)
+            if at_top and self.list_view.at_start:
+                self.list_view.widget.yview(0)
         else:
-            print("Database isn't synced with server")
-            #Add any new messages if needed
-            if new_msgs:
-                #Make list of msgs to attempt to show; ex: b'2417,2418,2419'
-                criteria = b','.join(new_msgs)
-                self.last_uid, msg_amt = self.service.show_msgs(self.label, criteria,
-                                                                self.add_updated_msg)
-
-            #Verify all messages currently in database as present on server
-            server_uids = self.service.get_all_uids(self.label)
-            for (client_uid,) in self.db_cursor.execute("SELECT uid FROM messages WHERE label = ?", (self.label,)):
-                #Remove any messages that the server removed since last sync
-                if client_uid not in server_uids:
-                    self.db_cursor.execute("DELETE FROM messages WHERE label = ? AND uid = ?",
-                                           (self.label, client_uid))
-                    print("Removed", client_uid)
-
-            assert len(self.db_cursor.execute("SELECT id FROM messages WHERE label = ?",
-                                              (self.label,)).fetchall()) == len(server_uids), "Number of messages on server not matching number of ids on client"
-            assert len(server_uids) == server_msg_amt
-
-            self.msg_amt = server_msg_amt
-            self.db_cursor.execute("UPDATE config SET value = ? WHERE key = ?",
-                                   (self.last_uid, "last_uid_"+self.label))
-            self.db_cursor.execute("UPDATE config SET value = ? WHERE key = ?",
-                                   (self.msg_amt, "msg_amt_"+self.label))
-            print("Database now synced")
+            #Newer/older rows are picked up when the user scrolls to them
+            self.list_view.at_end = False
 
     def show_subjects(self):
-        #Fills Listbox with subjects of each message
-        for id_, subject in self.db_cursor.execute("SELECT id, subject FROM messages WHERE label = ?", (self.label,)):
-            #Insert with small margin on left
-            safe_insert(self.list_view.widget, "end", "  "+subject)
-            #Map index in Listbox to id of message to retrieve
-            self.list_view.ids.append(id_)
+        #Fills Listbox with the first page of messages matching the search box
+        with profiled("show_subjects " + self.label):
+            self.list_view.reset()
+
+    def load_rows(self, key, older):
+        #Returns up to PAGE_SIZE (key, thread id, subject) rows that come after
+        #key (or before key, if not older) in the list, in display order. Uses
+        #keyset pagination, so each page is an index lookup
+        query = search_query(self.list_view.query.get())
+        if query:
+            #Lists each matching message, opening its thread when selected.
+            #CROSS JOIN makes sqlite look up matches first rather than scanning the label
+            sql = ("SELECT messages.id, messages.thread_id, messages.subject FROM messages_fts"
+                   + " CROSS JOIN messages ON messages.id = messages_fts.rowid"
+                   + " WHERE messages_fts MATCH ? AND label = ?")
+            params = [query, self.label]
+            key_columns = "messages_fts.rowid"
+        else:
+            #One row per thread, most recently active first
+            sql = ("SELECT date, id, id, subject || CASE WHEN msg_amt > 1"
+                   + " THEN ' (' || msg_amt || ')' ELSE '' END FROM threads"
+                   + " WHERE label = ? AND msg_amt > 0")
+            params = [self.label]
+            key_columns = "date, id"
+        if key is not None:
+            sql += f" AND ({key_columns}) {'<' if older else '>'} ({','.join('?'*len(key))})"
+            params += key
+        order = key_columns.replace(",", " DESC,") + " DESC" if older else key_columns
+        rows = self.db_cursor.execute(sql + f" ORDER BY {order} LIMIT ?",
+                                      params + [PAGE_SIZE]).fetchall()
+        if not older:
+            rows.reverse()
+        return [(row[:-2], row[-2], row[-1]) for row in rows]
 
     def switch_msg_view(self, name, i, mode):
+        #Shows every message in the selected thread, oldest first
+        index = self.list_view.current_msg.get()
+        thread_id = self.list_view.ids[index]
+        if thread_id == self.shown_thread:
+            #e.g. its row moved when rows were added above it
+            return
+        self.shown_thread = thread_id
+        with profiled(f"switch_msg_view {self.label} {thread_id}"):
+            if thread_id in self.thread_cache:
+                self.thread_cache.move_to_end(thread_id)
+                self.msg_view.show(self.thread_cache[thread_id])
+            else:
+                self.msg_view.show(self.load_thread(thread_id))
+            self.prefetch()
+
+    def load_thread(self, thread_id, download=True):
+        #Returns the messages of a thread as MessageView.show() takes them,
+        #caching them once complete. Bodies not in the db are downloaded in
+        #the background (and shown once they are), unless not download, in
+        #which case None is returned
+        rows = self.db_cursor.execute("SELECT id, uid, date, recipient, sender, subject, type,"
+                                      + " bodies.dict, bodies.data, bodies.links, version,"
+                                      + " rendered.dict, rendered.data, rendered.links"
+                                      + " FROM messages LEFT JOIN bodies USING (id)"
+                                      + " LEFT JOIN rendered USING (id)"
+                                      + " WHERE thread_id = ? ORDER BY date",
+                                      (thread_id,)).fetchall()
+        missing = [row[0] for row in rows if row[8] is None]
+        if missing and not download:
+            return None
+        msgs = []
+        #(id, HTML) of bodies too big to render without the UI stalling
+        unrendered = []
+        for (id_, uid, date, recipient, sender, subject, type_, dict_id, data, links,
+             version, rendered_dict, rendered_data, rendered_links) in rows:
+            date = time.strftime("%a, %d %b %Y %H:%M", time.localtime(date)) if date else ""
+            if data is None:
+                msgs.append((date, recipient, sender, subject, DOWNLOADING_TEXT, []))
+                continue
+            text = self.store.body_text(dict_id, data)
+            if type_ == "html":
+                if version == RENDERER_VERSION:
+                    text = self.store.body_text(rendered_dict, rendered_data)
+                    links = json.loads(rendered_links)
+                elif len(text) <= RENDER_INLINE_SIZE:
+                    text, links = render_html(text)
+                    self.store.add_rendered(id_, RENDERER_VERSION, text, links)
+                else:
+                    unrendered.append((id_, text))
+                    text, links = "(Rendering...)", []
+            elif links is None:
+                #Stored before link spans were; find them once and keep them
+                links = find_links(text)
+                if data is not None:
+                    self.db_cursor.execute("UPDATE bodies SET links = ? WHERE id = ?",
+                                           (json.dumps(links), id_))
+            else:
+                links = json.loads(links)
+            msgs.append((date, recipient, sender, subject, text, links))
+        #Committed right away, so background writers (syncing, prefetching)
+        #aren't kept waiting on the UI's transaction
+        self.store.commit()
+        if missing:
+            #Bodies not downloaded yet are fetched (and kept in the db) on the
+            #prefetcher's thread, so the UI never waits on the network
+            #Opening a thread marks its messages read
+            future = self.prefetcher.submit(self.label, [thread_id], peek=False)
+            self.parent.after(POLL_INTERVAL, self.downloaded, future, thread_id, msgs)
+        elif unrendered:
+            future = self.renderer.submit(render_bodies, unrendered)
+            self.parent.after(POLL_INTERVAL, self.rendered, future, thread_id)
+        else:
+            self.thread_cache[thread_id] = msgs
+            if len(self.thread_cache) > THREAD_CACHE_SIZE:
+                self.thread_cache.popitem(last=False)
+        return msgs
+
+    def rendered(self, future, thread_id):
+        #Waits for a background render (see switch_msg_view()) without blocking,
+        #then caches it and shows it if its thread is still selected
+        if not future.done():
+            self.parent.after(POLL_INTERVAL, self.rendered, future, thread_id)
+            return
+        results = future.result()
+        for id_, text, links in results:
+            self.store.add_rendered(id_, RENDERER_VERSION, text, links)
+        self.store.commit()
+        self.thread_cache.pop(thread_id, None)
+        index = self.list_view.current_msg.get()
+        if index < len(self.list_view.ids) and self.list_view.ids[index] == thread_id:
+            self.shown_thread = None
+            self.switch_msg_view(None, None, None)
+
+    def downloaded(self, future, thread_id, msgs):
+        #Waits for a thread's bodies to be downloaded (see load_thread()), then
+        #shows it if still selected; msgs is what's shown meanwhile
+        if not future.done():
+            self.parent.after(POLL_INTERVAL, self.downloaded, future, thread_id, msgs)
+            return
+        try:
+            future.result()
+        except Exception as e:
+            #Shown as failed below, rather than left downloading
+            print("Couldn't download messages:", repr(e))
         index = self.list_view.current_msg.get()
-        msg = self.db_cursor.execute("SELECT date, recipient, sender, subject, message_text"
-                                     +" FROM messages WHERE id = ? ORDER BY date DESC",
-                                     (self.list_view.ids[index],)).fetchone()
-        self.msg_view.show(msg)
+        if index >= len(self.list_view.ids) or self.list_view.ids[index] != thread_id:
+            return
+        loaded = self.load_thread(thread_id, download=False)
+        if loaded is None:
+            #The prefetcher reconnects; selecting the thread again retries, so
+            #switch_msg_view() mustn't take it as already shown
+            self.shown_thread = None
+            loaded = [msg[:4] + (DOWNLOAD_FAILED_TEXT, []) if msg[4] == DOWNLOADING_TEXT
+                      else msg for msg in msgs]
+        self.msg_view.show(loaded)
+
+    def prefetch(self):
+        #Loads the threads within PREFETCH_AMT rows of the selected one
+        #(nearest first) into the cache, downloading and rendering their
+        #bodies in the background, so moving to them is instant
+        if self.prefetching:
+            #Picks up the current selection once the running batch is done
+            return
+        index = self.list_view.current_msg.get()
+        ids = self.list_view.ids
+        nearby = [ids[j] for distance in range(1, PREFETCH_AMT + 1)
+                  for j in (index + distance, index - distance) if 0 <= j < len(ids)]
+        nearby = [thread_id for thread_id in dict.fromkeys(nearby)
+                  if thread_id not in self.thread_cache]
+        if nearby:
+            self.prefetching = True
+            future = self.prefetcher.submit(self.label, nearby)
+            self.parent.after(POLL_INTERVAL, self.prefetched, future, nearby)
+
+    def prefetched(self, future, thread_ids):
+        if not future.done():
+            self.parent.after(POLL_INTERVAL, self.prefetched, future, thread_ids)
+            return
+        self.prefetching = False
+        try:
+            future.result()
+        except Exception as e:
+            print("Couldn't prefetch messages:", repr(e))
+            return
+        loaded = [self.load_thread(thread_id, download=False) for thread_id in thread_ids
+                  if thread_id not in self.thread_cache]
+        #Bodies that failed to download are left for when their thread is
+        #opened; otherwise, the selection may have moved on meanwhile
+        if None not in loaded:
+            self.prefetch()
 
 class MessageView:
     """Purpose: Represents text widget at screen bottom; contains text of message(s)
@@ -196,29 +465,51 @@ class MessageView:
         self.widget.tag_bind("link", "<Leave>", lambda e: self.widget.config(cursor=""))
         self.widget.tag_bind("link", "<Button-1>", self.open_link)
 
+        #(line, column) where each shown link starts and ends, in order, and
+        #the URL it opens; searched with bisect when a link is clicked
+        self.link_starts = []
+        self.link_ends = []
+        self.link_urls = []
+
     def open_link(self, event):
-        char = self.widget.index(f"@{event.x},{event.y}")
-        ranges = [str(i) for i in self.widget.tag_ranges("link")]
-        char_line, char_letter = [int(n) for n in char.split(".")]
-        #Look at every second index; will give end-bound of link's location
-        for i in range(1, len(ranges), 2):
-            line, letter = [int(n) for n in ranges[i].split(".")]
-            if line >= char_line and letter >= char_letter:
-                start, end = ranges[i-1], ranges[i]
-                break
-        webbrowser.open_new_tab(self.widget.get(start, end).strip().strip("<>()"))
+        line, column = [int(n) for n in self.widget.index(f"@{event.x},{event.y}").split(".")]
+        i = bisect.bisect_right(self.link_starts, (line, column)) - 1
+        if i >= 0 and (line, column) < self.link_ends[i]:
+            webbrowser.open_new_tab(self.link_urls[i])
 
-    def show(self, msg):
+    def show(self, msgs):
+        #Shows a thread's (date, to, from, subject, text, link spans) messages,
+        #in order. Everything is inserted at once, already tagged
+        self.link_starts, self.link_ends, self.link_urls = [], [], []
+        #Alternating strings and their tags, as Text.insert() takes them
+        chunks = []
+        line = 1
+        for date, recipient, sender, subject, text, links in msgs:
+            header = displayable(f"Date: {date}\nTo: {recipient}\nFrom: {sender}\nSubject: {subject}\n\n")
+            chunks += [header, ("message_header",)]
+            line += header.count("\n")
+            text = displayable(text) + "\n"
+            #Offset in text up to which chunks (and lines) have been added
+            pos = 0
+            #Links found in HTML bodies also carry the URL they point to
+            for start, end, *url in links:
+                line += text.count("\n", pos, start)
+                self.link_starts.append((line, start - (text.rfind("\n", 0, start) + 1)))
+                #Links rendered from HTML may span lines (bare URLs never do)
+                line += text.count("\n", start, end)
+                self.link_ends.append((line, end - (text.rfind("\n", 0, end) + 1)))
+                self.link_urls.append(url[0] if url else text[start:end].strip().strip("<>()"))
+                chunks += [text[pos:start], (), text[start:end], ("link",)]
+                pos = end
+            chunks += [text[pos:], ()]
+            line += text.count("\n", pos)
+            chunks += [" "*self.widget.cget("width") + "\n", ("separator",)]
+            line += 1
         self.widget.configure(state="normal")
-        self.widget.delete("0.0", "end")
-        safe_insert(self.widget, "end", f"Date: {msg[0]}\nTo: {msg[1]}\nFrom: {msg[2]}\nSubject: {msg[3]}\n\n", tags=("message_header",))
-        safe_insert(self.widget, "end", msg[4] + "\n")
-        self.widget.insert("end", " "*self.widget.cget("width") + "\n", ("separator",))
+        self.widget.delete("1.0", "end")
+        if chunks:
+            self.widget.insert("end", *chunks)
         self.widget.configure(state="disabled")
-        #Make all URLs in text into clickable links
-        for i, row in enumerate(self.widget.get("0.0", "end").split("\n")):
-            for match in re.finditer(r'<?https?://[^\s]+>?((?<!\s)|$)', row):
-                self.widget.tag_add("link", f"{i+1}.{match.start()}", f"{i+1}.{match.end()}")
 
 class App:
     def __init__(self, parent):
@@ -226,21 +517,105 @@ class App:
         compose = Button(self.parent, text="Compose")
         compose.bind("<Button-1>", lambda e: self.compose_msg())
         compose.pack(ipadx=5)
+        #Shows what background workers are doing
+        self.status = Label(self.parent, text="")
+        self.status.pack()
+        #Lists every mailbox on the server; selecting one switches to it
+        self.sidebar = Listbox(self.parent, exportselection=False)
+        self.sidebar.pack(side=LEFT, fill=Y)
+        self.sidebar.bind("<<ListboxSelect>>", lambda e: self.switch_mailbox())
+        #Holds the controller of the mailbox being shown
+        self.content = Frame(self.parent)
+        self.content.pack(side=LEFT, fill=BOTH, expand=1)
+        #Doesn't connect until first used (e.g. to download a message body)
         self.service = MailService()
-        self.db = sqlite3.connect('mail.db')
-        self.db_cursor = self.db.cursor()
-        self.inbox = MailboxController(self.parent, self.service, "INBOX", self.db_cursor)
-        #Add code to close db, db_cursor when app shuts down
+        self.store = Store("mail.db", self.service.config)
+        self.db_cursor = self.store.cursor
+        #Shared by every mailbox, so there's one extra connection at most
+        self.prefetcher = Prefetcher(self.service.config)
+        #Made when a mailbox is first shown, then kept so switching back is instant
+        self.controllers = {}
+        self.current = None
+        self.show_mailboxes()
+        self.switch_mailbox("INBOX")
+        #Syncing runs on its own thread, posting (event, label, ...) tuples here
+        self.events = queue.Queue()
+        self.sync_worker = SyncWorker(self.events, config=self.service.config)
+        self.sync_worker.start()
+        #Sends composed messages (and any left over from last time) in the background
+        self.outbox = OutboxSender(self.events, self.service.config)
+        self.outbox.start()
+        self.poll_events()
+
+    def show_mailboxes(self):
+        #Fills the sidebar with the mailboxes found by the last sync
+        self.mailboxes = self.store.mailboxes() or ["INBOX"]
+        self.sidebar.delete(0, END)
+        for label in self.mailboxes:
+            self.sidebar.insert(END, label)
+        if self.current in self.mailboxes:
+            self.sidebar.selection_set(self.mailboxes.index(self.current))
+
+    def switch_mailbox(self, label=None):
+        #Shows the given mailbox (or the one selected in the sidebar)
+        if label is None:
+            selection = self.sidebar.curselection()
+            if not selection:
+                return
+            label = self.mailboxes[selection[0]]
+        if label == self.current:
+            return
+        if self.current in self.controllers:
+            self.controllers[self.current].hide()
+        if label not in self.controllers:
+            self.controllers[label] = MailboxController(self.content, self.service, label,
+                                                        self.store, self.prefetcher)
+        self.controllers[label].show()
+        self.current = label
+
+    def poll_events(self):
+        #Applies updates posted by background workers; runs on the Tk thread
+        while True:
+            try:
+                event, label = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "mailboxes":
+                self.show_mailboxes()
+            elif event == "syncing":
+                self.status.config(text="Syncing " + label + "...")
+            elif event == "changed":
+                #Mailboxes not shown yet will load fresh rows when they are
+                if label in self.controllers:
+                    self.controllers[label].db_changed()
+            elif event == "synced":
+                self.status.config(text=label + " is up to date")
+            elif event == "failed":
+                self.status.config(text="Error: couldn't sync " + (label or "mailboxes"))
+            elif event == "sending":
+                self.status.config(text="Sending " + label + "...")
+            elif event == "sent":
+                self.status.config(text="Sent " + label)
+            elif event == "send_retry":
+                self.status.config(text="Couldn't send " + label)
+            elif event == "send_failed":
+                self.status.config(text="Error: couldn't send " + label)
+                messagebox.showinfo(message="Error: " + label + " failed to send")
+        self.parent.after(POLL_INTERVAL, self.poll_events)
 
     def send_msg(self):
         text = self.compose_area.get("1.0", "end").strip()
         to = self.to_line.get()
         subject = self.subject_line.get()
-        if self.service.send_msg(to, subject, text):
-            messagebox.showinfo(message="Email sent successfully")
-            self.win.destroy()
-        else:
-            messagebox.showinfo(message="Error: Email failed to send")
+        if not recipients(to):
+            messagebox.showinfo(message="Error: No recipient given")
+            return
+        #Sent by self.outbox, which reports back through poll_events()
+        self.store.queue_msg(to, subject, text)
+        self.store.commit()
+        self.outbox.notify()
+        self.status.config(text="Queued \"" + subject + "\" to send")
+        self.win.destroy()
 
     def save_draft(self):
         to = self.to_line.get()
@@ -252,6 +627,7 @@ class App:
         except sqlite3.Error:
             messagebox.showinfo(message="Error: Draft failed to save")
         else:
+            self.store.commit()
             messagebox.showinfo(message="Draft saved successfully")
             self.win.destroy()
 
@@ -275,16 +651,48 @@ class App:
         self.compose_area.pack(fill=BOTH, expand=1)
 
     def cleanup_db(self):
-        self.db.commit()
-        self.db_cursor.close()
-        self.db.close()
+        self.store.close()
         print("Database successfully shutdown")
 
+class StatsWindow:
+    """Purpose: Debug window showing what IMAP/SMTP commands, SQL statements
+        and parsing have cost so far (see Stats); opened by --stats"""
+    def __init__(self, parent):
+        self.parent = parent
+        self.win = Toplevel(parent)
+        self.win.title("Stats")
+        self.widget = Text(self.win, width=56, height=30, font="TkFixedFont")
+        self.widget.pack(fill=BOTH, expand=1)
+        self.refresh()
+
+    def refresh(self):
+        if not self.win.winfo_exists():
+            return
+        self.widget.delete("1.0", "end")
+        self.widget.insert("end", STATS.report())
+        self.parent.after(STATS_INTERVAL, self.refresh)
+
 def main():
+    parser = argparse.ArgumentParser(description="Email client")
+    parser.add_argument("--stats", action="store_true",
+                        help="show IMAP/SMTP/SQL counters in a window, and print them on exit")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR",
+                        help="profile connecting, syncing, listing and opening messages,"
+                        + " writing .pstats files and allocation reports to DIR"
+                        + " (default: profile)")
+    args = parser.parse_args()
+    if args.profile:
+        start_profiling(args.profile)
     root = Tk()
     root.title("Email Client")
     app = App(root)
+    if args.stats:
+        StatsWindow(root)
     root.mainloop()
+    app.sync_worker.stop()
     app.cleanup_db()
+    if args.stats:
+        print(STATS.report())
 
-main()
+if __name__ == "__main__":
+    main()
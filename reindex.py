@@ -0,0 +1,11 @@
+#Re-parses the messages downloaded in "archive" sync mode from the local pack
+#files, e.g. after a parser fix; doesn't connect to the server
+import sys, time
+sys.path.append("services")
+from sync import *
+
+store = Store("mail.db", MailService().config)
+start = time.perf_counter()
+msg_amt = reindex(store)
+store.close()
+print("Re-parsed", msg_amt, "messages in", round(time.perf_counter() - start, 1), "seconds")
@@ -1,22 +1,366 @@
-import imaplib, smtplib, sys, email, email.policy, json, re, datetime
-from email.mime.text import MIMEText
+import imaplib, sys, email, email.policy, email.utils, json, re, datetime, queue, threading
+import socket, time, base64, binascii, quopri, itertools, zlib
+from stats import *
+from profiler import *
+
+#Lets imaplib send COMPRESS (RFC 4978) once logged in
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+#Bytes read off the socket at a time once the connection is compressed
+READ_SIZE = 65536
+
+#Max number of messages requested in a single UID FETCH
+FETCH_CHUNK_SIZE = 1000
+#Headers needed to list a message without downloading its body
+HEADER_FIELDS = ("BODY.PEEK[HEADER.FIELDS (From To Subject Date Message-ID In-Reply-To"
+                 + " References)]")
+#Seconds before IDLE is re-issued; servers may drop clients idle for 29 minutes
+IDLE_RENEW = 25 * 60
+#Seconds to wait for related updates (e.g. several EXPUNGEs) before handling them
+IDLE_BATCH = 1
+#Seconds to wait before reconnecting after the IDLE connection drops
+IDLE_RETRY = 30
+
+#Set when the app closes (see SyncWorker.stop()); fetch_msgs() then stops
+#before its next chunk, so closing never waits on a long download
+STOP_SYNCING = threading.Event()
+
+class SyncStopped(Exception):
+    """Purpose: Raised by fetch_msgs() once STOP_SYNCING is set"""
+
+def uid_sets(uids, chunk_size):
+    #Yields IMAP sequence sets (e.g. '1:5,9') covering the given UIDs,
+    #each naming at most chunk_size messages
+    uids = sorted(uids)
+    for i in range(0, len(uids), chunk_size):
+        ranges = []
+        start = end = uids[i]
+        for uid in uids[i+1:i+chunk_size]:
+            if uid == end + 1:
+                end = uid
+            else:
+                ranges.append((start, end))
+                start = end = uid
+        ranges.append((start, end))
+        yield ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+def quote(mailbox):
+    #imaplib sends arguments as-is; names like "[Gmail]/Sent Mail" need quotes
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def seq_ranges(seq_set):
+    #Turns an IMAP sequence set (e.g. '1:5,9') into a list of (start, end) pairs
+    ranges = []
+    for part in seq_set.split(","):
+        start, sep, end = part.partition(":")
+        ranges.append(tuple(sorted((int(start), int(end or start)))))
+    return ranges
+
+def fetch_responses(data):
+    #imaplib flattens a multi-message FETCH response into a list of
+    #(header, literal) tuples and plain bytes; regroup it into one
+    #(metadata, {item name: literal}) pair per message
+    responses = []
+    for item in data:
+        if item is None:
+            continue
+        head = item[0] if isinstance(item, tuple) else item
+        if re.match(rb'\d+ \(', head):
+            responses.append([b"", {}])
+        meta, literals = responses[-1]
+        if isinstance(item, tuple):
+            name = re.search(rb'((?:RFC822|BODY|BINARY)[\w.]*(?:\[[^\]]*\])?(?:<\d+>)?)'
+                             + rb' \{\d+\}$', head, re.IGNORECASE)
+            if name:
+                literals[name.group(1).upper()] = item[1]
+            else:
+                #A string sent as a literal inside a list (e.g. a filename in
+                #BODYSTRUCTURE); put it back in quoted form
+                head = (head[:head.rindex(b"{")] + b'"'
+                        + item[1].replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"')
+        responses[-1][0] = meta + head
+    return responses
+
+def parse_list(data):
+    #Parses the IMAP parenthesized list at the start of data into nested lists
+    #of strings, with None for NIL. Stops at the list's closing parenthesis
+    stack = [[]]
+    for token in re.findall(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+', data):
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            item = stack.pop()
+            stack[-1].append(item)
+            if len(stack) == 1:
+                break
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode(errors="replace"))
+        elif token.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode(errors="replace"))
+    return stack[0][0]
+
+def text_parts(structure, section=""):
+    #Yields (section, subtype, encoding, charset) for each text part of a
+    #parsed BODYSTRUCTURE that isn't an attachment
+    if isinstance(structure[0], list):
+        #Multipart: the child parts come first, then the subtype and extensions
+        children = itertools.takewhile(lambda part: isinstance(part, list), structure)
+        for i, part in enumerate(children, 1):
+            yield from text_parts(part, f"{section}.{i}" if section else str(i))
+        return
+    if (structure[0] or "").lower() != "text":
+        return
+    #Text parts have a line count, then MD5 and disposition
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and (disposition[0] or "").lower() == "attachment":
+        return
+    params = structure[2] or []
+    params = {key.lower(): value for key, value in zip(params[::2], params[1::2])}
+    #A single-part message's body is section 1
+    yield (section or "1", (structure[1] or "").lower(), (structure[5] or "7bit").lower(),
+           params.get("charset"))
+
+def pick_text_part(structure):
+    #Chooses the part to display, preferring plain text over HTML, as
+    #parse_body() does; returns None if there is neither
+    parts = list(text_parts(structure))
+    for part in parts:
+        if part[1] == "plain":
+            return part
+    for part in parts:
+        if "html" in part[1]:
+            return part
+    return None
+
+def decode_part(data, encoding, charset):
+    #Undoes a part's transfer encoding and charset
+    try:
+        if encoding == "base64":
+            data = base64.b64decode(data)
+        elif encoding == "quoted-printable":
+            data = quopri.decodestring(data)
+    except binascii.Error:
+        print("Couldn't decode", encoding, "part")
+    try:
+        text = data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        text = data.decode("utf-8", errors="replace")
+    return text.replace("\r\n", "\n")
+
+def fetch_uid(meta):
+    #Returns the UID in a FETCH response's metadata, or None
+    match = re.search(rb'UID (\d+)', meta)
+    return int(match.group(1)) if match else None
+
+def fetch_item(meta, name):
+    #Returns the parsed value of a FETCH item sent as a parenthesized list
+    start = meta.upper().index(name + b" (") + len(name) + 1
+    return parse_list(meta[start:])
+
+def parse_date(date_str):
+    #Returns a Date header as seconds since the epoch, or None if it can't be read
+    try:
+        date = email.utils.parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError):
+        print("Couldn't read date:", date_str)
+        return None
+    if date.tzinfo is None:
+        #"-0000" means the zone is unknown; RFC 5322 says to treat it as UTC
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+def internal_date(meta):
+    #Returns the INTERNALDATE (when the server got the message) in a FETCH
+    #response as seconds since the epoch, or 0 if it's missing
+    date = imaplib.Internaldate2tuple(meta)
+    return int(time.mktime(date)) if date else 0
+
+def parse_headers(raw_bytes):
+    #Extracts the list-view fields from a message's (possibly partial) headers
+    msg = {}
+    #Same as email.message_from_bytes(), but also takes a memoryview (e.g.
+    #into a pack file) without copying it first
+    raw_msg = email.message_from_string(str(raw_bytes, "ascii", "surrogateescape"),
+                                        policy=email.policy.SMTP)
+    msg["subject"] = raw_msg.get("Subject", "")
+    msg["from"] = raw_msg.get("From")
+    msg["to"] = raw_msg.get("To")
+    msg["message_id"] = raw_msg.get("Message-ID")
+    #Messages this one replies to, for threading
+    msg["refs"] = " ".join(str(raw_msg.get(name, "")) for name in ("References", "In-Reply-To"))
+    #None if missing or malformed; fetch_msgs() then uses INTERNALDATE
+    msg["date"] = parse_date(str(raw_msg.get("Date", "")))
+    #Body is downloaded later, the first time the message is opened
+    msg["text"] = None
+    msg["type"] = None
+    return msg, raw_msg
+
+def parse_body(raw_msg):
+    #Returns (type, text) for the displayable part of a parsed message
+    if not raw_msg.is_multipart():
+        #e.g. a lone PDF, whose content is bytes; like pick_text_part(),
+        #nothing is shown for it
+        if raw_msg.get_content_maintype() != "text":
+            return "text", ""
+        if "html" in raw_msg.get_content_type():
+            return "html", raw_msg.get_content()
+        return "text", raw_msg.get_content()
+    for part in raw_msg.walk():
+        if part.get_content_type() == "text/plain":
+            return "text", part.get_content()
+    for part in raw_msg.walk():
+        if part.get_content_type() == "text/html":
+            return "html", part.get_content()
+    return "text", ""
+
+def parse_msg(raw_bytes):
+    #Extracts the headers and displayable text of a raw RFC822 message
+    msg, raw_msg = parse_headers(raw_bytes)
+    msg["type"], msg["text"] = parse_body(raw_msg)
+    return msg
+
+class MailIMAP:
+    """Purpose: Mixed into imaplib's classes: adds each command's count and
+        time, and the bytes sent and received, to STATS, and can compress the
+        connection with COMPRESS=DEFLATE (see start_compression())"""
+    #Raw deflate streams each way, once compression has started
+    compressor = None
+    decompressor = None
+
+    def _simple_command(self, name, *args):
+        #UID commands are counted by what they do, e.g. "imap UID FETCH"
+        label = name + " " + args[0] if name == "UID" else name
+        with STATS.timed("imap " + label):
+            return super()._simple_command(name, *args)
+
+    def start_compression(self):
+        #Everything sent either way after the server's OK is deflated;
+        #returns whether the server agreed
+        status, data = self._simple_command("COMPRESS", "DEFLATE")
+        if status != "OK":
+            return False
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        #Inflated bytes not read yet. Reads go straight to the socket from
+        #now on, so imaplib's buffered file (empty after the OK) isn't used
+        self.inflated = bytearray()
+        return True
+
+    def send(self, data):
+        if self.compressor is not None:
+            #Flushed, or the server would wait for more before inflating it
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        STATS.add("imap bytes out", len(data))
+        super().send(data)
+
+    def recv(self):
+        #Returns the next bytes the server sends (at least one, unless the
+        #connection closed), waiting at most the socket's timeout; for
+        #reading responses imaplib can't parse, e.g. during IDLE
+        if self.decompressor is None:
+            data = self.sock.recv(READ_SIZE)
+            STATS.add("imap bytes in", len(data))
+            return data
+        try:
+            while not self.inflated:
+                self.fill()
+        except self.abort:
+            return b""
+        data = bytes(self.inflated)
+        self.inflated.clear()
+        return data
+
+    def fill(self):
+        #Inflates more of the server's stream into self.inflated
+        data = self.sock.recv(READ_SIZE)
+        if not data:
+            raise self.abort("socket error: EOF")
+        STATS.add("imap bytes in", len(data))
+        inflated = self.decompressor.decompress(data)
+        STATS.add("imap bytes inflated", len(inflated))
+        self.inflated += inflated
+
+    def read(self, size):
+        if self.decompressor is None:
+            data = super().read(size)
+            STATS.add("imap bytes in", len(data))
+            return data
+        while len(self.inflated) < size:
+            self.fill()
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def readline(self):
+        if self.decompressor is None:
+            line = super().readline()
+            STATS.add("imap bytes in", len(line))
+            return line
+        while (end := self.inflated.find(b"\n")) < 0:
+            self.fill()
+        line = bytes(self.inflated[:end + 1])
+        del self.inflated[:end + 1]
+        return line
+
+class MailIMAP4(MailIMAP, imaplib.IMAP4):
+    pass
+
+class MailIMAP4_SSL(MailIMAP, imaplib.IMAP4_SSL):
+    pass
 
 class MailService:
-    def __init__(self):
-        with open("config.json") as config_file:
-            self.config = json.loads(config_file.read())
+    def __init__(self, config=None):
+        #The contents of config.json, unless given (e.g. by benchmarks)
+        if config is None:
+            with open("config.json") as config_file:
+                config = json.loads(config_file.read())
+        self.config = config
+
+        #The IMAP connection; opened the first time it's needed (see api)
+        self._api = None
+        #Name of mailbox currently open on the server
+        self.selected = None
+        #HIGHESTMODSEQ of the selected mailbox, if the server tracks one
+        self.highest_modseq = None
 
-        self.api = imaplib.IMAP4_SSL(self.config["host"])
+    @property
+    def api(self):
+        #Connecting lazily lets the UI start without waiting on the network
+        if self._api is None:
+            with profiled("connect " + self.config["host"]):
+                self.connect()
+        return self._api
+
+    def connect(self):
+        #"ssl": false is only for servers on this machine, e.g. fake ones
+        if self.config.get("ssl", True):
+            self._api = MailIMAP4_SSL(self.config["host"], self.config.get("port", 993))
+        else:
+            self._api = MailIMAP4(self.config["host"], self.config.get("port", 143))
         print("Connected to", self.config["host"])
         try:
-            self.api.login(self.config["username"], self.config["password"])
+            self._api.login(self.config["username"], self.config["password"])
         except imaplib.IMAP4.error:
             print("Error: Cannot login to IMAP")
             sys.exit(1)
         print("Logged in to IMAP")
+        #Servers often advertise more capabilities once logged in
+        status, data = self._api.capability()
+        self._api.capabilities = tuple(data[-1].decode().upper().split())
+        #With QRESYNC enabled, the server reports expunged UIDs (VANISHED)
+        #and mod-sequences, so resyncing needs no full list of UIDs
+        self.qresync = "QRESYNC" in self._api.capabilities
+        if self.qresync:
+            self._api.enable("QRESYNC")
+        #Mail is mostly text, so this shrinks what's downloaded severalfold
+        if "COMPRESS=DEFLATE" in self._api.capabilities and self.config.get("compress", True):
+            self._api.start_compression()
 
-        #To speed up startup, only connect right before 1st message sent
-        self.smtp_connected = False
+    def reconnect(self):
+        #Drops a broken connection; the next use of api opens a new one
+        self._api = None
+        self.selected = None
 
     def error_check(self, status, message):
         if "OK" not in status:
@@ -27,102 +371,362 @@ class MailService:
             print("Error: UID values have changed:", status)
             sys.exit(1)
 
-    def get_all_uids(self, mailbox):
-        status, data = self.api.select(mailbox)
+    def select(self, mailbox):
+        #Opens mailbox, returning the number of messages in it
+        status, data = self.api.select(quote(mailbox))
         self.error_check(status, "couldn't open mailbox")
+        self.selected = mailbox
+        code, modseq = self.api.response("HIGHESTMODSEQ")
+        self.highest_modseq = int(modseq[-1]) if modseq[-1] else None
+        return int(data[0])
+
+    def list_mailboxes(self):
+        #Returns the names of all mailboxes on the server that can be opened
+        status, data = self.api.list()
+        self.error_check(status, "couldn't list mailboxes")
+        mailboxes = []
+        for item in data:
+            if isinstance(item, tuple):
+                #Name sent as a literal
+                flags, name = item[0], item[1].decode()
+            else:
+                match = re.match(rb'\((.*?)\) (?:"(?:[^"\\]|\\.)*"|NIL) (.*)$', item)
+                flags, name = match.group(1), match.group(2).decode()
+                if name.startswith('"'):
+                    name = re.sub(r'\\(.)', r'\1', name[1:-1])
+            if not re.search(rb'\\(?i:Noselect|NonExistent)', flags):
+                mailboxes.append(name)
+        return mailboxes
+
+    def get_all_uids(self, mailbox):
+        self.select(mailbox)
         status, data = self.api.uid("SEARCH", b'ALL')
         return [int(i) for i in data[0].split()]
 
-    def show_msgs(self, mailbox, criteria, callback):
+    def show_msgs(self, mailbox, criteria, callback, mode="full", chunk_done=None):
+        #Passes each message matching criteria to callback; see fetch_msgs()
+        #for modes and chunk_done
         print("Getting messages...")
-        status, data = self.api.select(mailbox)
-        self.error_check(status, "couldn't open mailbox")
+        all_uids = self.search(mailbox, criteria)
+        last_uid = max(all_uids, default=None)
+        msg_amt = len(all_uids)
+        self.fetch_msgs(mailbox, all_uids, callback, mode, chunk_done)
+        print(" All messages downloaded")
+        return last_uid, msg_amt
+
+    def search(self, mailbox, criteria):
+        #Returns the UIDs of messages in mailbox matching criteria
+        self.select(mailbox)
         print(" Selected", mailbox)
-        status, data = self.api.search(None, criteria)
+        status, data = self.api.uid("SEARCH", criteria)
         self.error_check(status, "couldn't search")
-        all_msgs = data[0].split()
-        print(" Searched using:", criteria)
-        print(" Server data:", all_msgs)
-        last_uid = None
-        msg_amt = len(all_msgs)
-        for i, n in enumerate(all_msgs):
-            msg = {}
-            status, msg_data = self.api.fetch(n, '(UID RFC822)')
-            self.error_check(status, "couldn't fetch " + str(n))
-            num, uid_label, uid, tail = msg_data[0][0].split(b' ', 3)
-            msg["uid"] = int(uid)
-            raw_msg = email.message_from_bytes(msg_data[0][1], policy=email.policy.SMTP)
-            msg["subject"] = raw_msg.get("Subject")
-            msg["from"] = raw_msg.get("From")
-            msg["to"] = raw_msg.get("To")
-            date_str = raw_msg.get("Date")
-            if re.findall(r'^[A-Za-z]{3}, [0-9]{2} [A-Za-z]{3} [0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2} (\+|-)[0-9]{4}$', date_str):
-                date = datetime.datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z")
-                msg["internalDate"] = date.ctime()
-            else:
-                print("Time string failed to match format:", date_str)
-                msg["internalDate"] = date_str
-            msg["text"] = ""
-            msg["type"] = "text"
-            if not raw_msg.is_multipart():
-                print("Subject:", msg["subject"], "Content Type:", raw_msg.get_content_type())
-                if "html" in raw_msg.get_content_type():
-                    msg["type"] = "html"
-                msg["text"] = raw_msg.get_content()
+        all_uids = [int(i) for i in data[0].split()]
+        print(" Searched using:", criteria, "found", len(all_uids))
+        return all_uids
+
+    def fetch_msgs(self, mailbox, uids, callback, mode="full", chunk_done=None):
+        #Passes each message with one of the given UIDs to callback. In
+        #"headers" mode, bodies are left as None, to be downloaded later using
+        #fetch_body(); "full" mode downloads just the text of each message, and
+        #"archive" mode the whole raw message, passed on as msg["raw"].
+        #chunk_done (if given) is called after each chunk's messages, before
+        #the next round trip
+        if self.selected != mailbox:
+            self.select(mailbox)
+        if mode == "headers":
+            items = f"(UID RFC822.SIZE INTERNALDATE {HEADER_FIELDS})"
+        elif mode == "archive":
+            items = "(UID RFC822.SIZE INTERNALDATE BODY.PEEK[])"
+        else:
+            #The structure tells which part holds the text, so attachments
+            #are never downloaded
+            items = f"(UID RFC822.SIZE INTERNALDATE BODYSTRUCTURE {HEADER_FIELDS})"
+        wanted = set(uids)
+        #Fetch many messages per round trip instead of one at a time
+        for uid_set in uid_sets(uids, FETCH_CHUNK_SIZE):
+            if STOP_SYNCING.is_set():
+                raise SyncStopped()
+            status, msg_data = self.api.uid("FETCH", uid_set, items)
+            self.error_check(status, "couldn't fetch " + uid_set)
+            msgs, parts = [], {}
+            for meta, literals in fetch_responses(msg_data):
+                #Servers may add unsolicited responses, e.g.
+                #"* 7 FETCH (FLAGS (\Seen) UID 9)" after another client
+                #changed a flag; only the ones holding what was asked for count
+                uid = fetch_uid(meta)
+                if uid not in wanted or len(literals) != 1 or b"RFC822.SIZE" not in meta \
+                   or (mode == "full" and b"BODYSTRUCTURE (" not in meta.upper()):
+                    continue
+                if mode == "archive":
+                    with STATS.timed("parse message"):
+                        msg = parse_msg(literals[b"BODY[]"])
+                    msg["raw"] = literals[b"BODY[]"]
+                else:
+                    (raw_headers,) = literals.values()
+                    with STATS.timed("parse headers"):
+                        msg, raw_msg = parse_headers(raw_headers)
+                msg["uid"] = uid
+                msg["size"] = int(re.search(rb'RFC822\.SIZE (\d+)', meta).group(1))
+                if msg["date"] is None:
+                    msg["date"] = internal_date(meta)
+                if mode == "full":
+                    parts[msg["uid"]] = pick_text_part(fetch_item(meta, b"BODYSTRUCTURE"))
+                msgs.append(msg)
+            bodies = self.fetch_parts(parts)
+            for msg in msgs:
+                if msg["uid"] in bodies:
+                    msg["type"], msg["text"] = bodies[msg["uid"]]
+                callback(msg)
+            if chunk_done is not None:
+                chunk_done()
+
+    def fetch_parts(self, parts, peek=True):
+        #Downloads just the given part of each message in the selected
+        #mailbox, with one FETCH per distinct section number. parts maps
+        #UIDs to pick_text_part() results; returns {uid: (type, text)}
+        bodies = {}
+        sections = {}
+        for uid, part in parts.items():
+            if part is None:
+                bodies[uid] = ("text", "")
             else:
-                found = False
-                for part in raw_msg.walk():
-                    if part.get_content_type() == "text/plain":
-                        msg["text"] = part.get_content()
-                        found = True
-                        break
-                if not found:
-                    for part in raw_msg.walk():
-                        content_type = part.get_content_type()
-                        print("Subject:", msg["subject"], "Content Type:", content_type)
-                        if "html" in content_type:
-                            msg["text"] = part.get_content()
-                            msg["type"] = "html"
-                            break
-            callback(msg)
-            if i == (msg_amt-1):
-                last_uid = msg["uid"]
-        print(" All messages downloaded")
-        return last_uid, msg_amt
+                sections.setdefault(part[0], []).append(uid)
+        for section, uids in sections.items():
+            #Without PEEK, the server marks the messages as read
+            item = f"BODY{'.PEEK' if peek else ''}[{section}]"
+            status, data = self.api.uid("FETCH", next(uid_sets(uids, len(uids))),
+                                        f"(UID {item})")
+            self.error_check(status, "couldn't fetch section " + section)
+            for meta, literals in fetch_responses(data):
+                uid = fetch_uid(meta)
+                #Skips unsolicited responses (see fetch_msgs())
+                if uid not in parts or f"BODY[{section}]".encode() not in literals:
+                    continue
+                section, subtype, encoding, charset = parts[uid]
+                with STATS.timed("parse part"):
+                    text = decode_part(literals[f"BODY[{section}]".encode()],
+                                       encoding, charset)
+                bodies[uid] = ("html" if "html" in subtype else "text", text)
+        return bodies
+
+    def fetch_bodies(self, mailbox, uids, peek=False):
+        #Downloads the bodies of messages listed by a headers-only sync;
+        #returns {uid: (type, text)}. Unless peek, they're marked as read
+        if self.selected != mailbox:
+            self.select(mailbox)
+        uid_set = next(uid_sets(uids, len(uids)))
+        status, data = self.api.uid("FETCH", uid_set, "(UID BODYSTRUCTURE)")
+        self.error_check(status, "couldn't fetch structure of " + uid_set)
+        parts = {fetch_uid(meta): pick_text_part(fetch_item(meta, b"BODYSTRUCTURE"))
+                 for meta, literals in fetch_responses(data)
+                 if fetch_uid(meta) in uids and b"BODYSTRUCTURE (" in meta.upper()}
+        #Opening a message marks it as read, like fetching all of it did
+        bodies = self.fetch_parts(parts, peek)
+        #Messages deleted from the server meanwhile come back empty
+        return {uid: bodies.get(uid, ("text", "")) for uid in uids}
+
+    def sync_changes(self, mailbox, last_uid, modseq):
+        #Uses QRESYNC to find what changed since modseq; returns
+        #(server_msg_amt, new UIDs, ranges of expunged UIDs), or None if the
+        #server can't report changes this way
+        server_msg_amt = self.select(mailbox)
+        if not self.qresync or self.highest_modseq is None:
+            return None
+        if self.highest_modseq == modseq:
+            return server_msg_amt, [], []
+        status, data = self.api.uid("FETCH", "1:*", f"(UID) (CHANGEDSINCE {modseq} VANISHED)")
+        self.error_check(status, "couldn't perform CHANGEDSINCE sync")
+        new_uids = [uid for uid in re.findall(rb'UID (\d+)', b' '.join(d for d in data if d))
+                    if int(uid) > (last_uid or 0)]
+        vanished = []
+        code, responses = self.api.response("VANISHED")
+        for response in responses:
+            if response:
+                vanished += seq_ranges(response.split()[-1].decode())
+        return server_msg_amt, new_uids, vanished
 
     def sync_status(self, mailbox, last_uid, client_msg_amt):
         last_uid_str = bytes(str(last_uid), "utf-8")
-        status, data = self.api.select(mailbox)
-        self.error_check(status, "couldn't open mailbox")
-        server_msg_amt = int(data[0])
+        server_msg_amt = self.select(mailbox)
 
         status, data = self.api.uid("FETCH", last_uid_str + b':*', "UID")
-        new_msgs = [i.split()[0] for i in data
-                    if not i.endswith(b' '+last_uid_str+b')')]
+        #Keyed by UID; sequence numbers shift whenever messages are expunged
+        new_msgs = [uid for uid in re.findall(rb'UID (\d+)', b' '.join(data))
+                    if int(uid) > last_uid]
         self.error_check(status, "couldn't perform FETCH sync")
-        print(data, client_msg_amt, server_msg_amt, new_msgs)
         #Ensure same amt of msgs as last sync, no new msgs added/removed
         is_synced = len(data) == 1 and client_msg_amt == server_msg_amt \
                     and data[-1].endswith(b' '+last_uid_str + b')')
         return is_synced, server_msg_amt, new_msgs
 
-    def send_msg(self, to, subject, text):
-        if not self.smtp_connected:
-            self.smtp = smtplib.SMTP_SSL("smtp.gmail.com")
+class ServicePool:
+    """Purpose: Shares at most size MailService connections between threads"""
+    def __init__(self, size, config=None):
+        self.size = size
+        #Passed to each MailService made
+        self.config = config
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        #Returns an idle connection, making one if under the limit; otherwise
+        #waits for one to be returned with put()
+        with self.lock:
+            if self.idle.empty() and self.created < self.size:
+                self.created += 1
+                return MailService(self.config)
+        return self.idle.get()
+
+    def put(self, service):
+        self.idle.put(service)
+
+class IdleListener(threading.Thread):
+    """Purpose: Watches one mailbox for changes on a dedicated connection using
+        IMAP IDLE, calling on_change(mailbox, new UIDs, expunged UIDs)"""
+    def __init__(self, mailbox, last_uid, on_change, modseq=None, config=None):
+        super().__init__(daemon=True)
+        self.mailbox = mailbox
+        #Highest UID already reported; anything above it is new
+        self.last_uid = last_uid or 0
+        self.on_change = on_change
+        #Read from config.json if None
+        self.service = MailService(config)
+        #With QRESYNC, the mod-sequence changes were last reported up to
+        self.modseq = modseq
+        #UID of each message in the mailbox, by sequence number - 1; needed
+        #since EXPUNGE responses name messages by sequence number. Stays None
+        #with QRESYNC, as the server then names expunged messages by UID
+        self.uids = None
+        self.idle_amt = 0
+
+    def run(self):
+        while True:
             try:
-                self.smtp.ehlo_or_helo_if_needed()
-                self.smtp.login(self.config["username"], self.config["password"])
-                self.smtp_connected = True
-            except smtplib.SMTPException as e:
-                print("Error:", e)
-                sys.exit(1)
-            print("Logged in to SMTP")
-
-        msg = MIMEText(text)
-        msg["to"], msg["from"], msg["subject"] = to, self.config["username"], subject
+                if "IDLE" not in self.service.api.capabilities:
+                    print("Server doesn't support IDLE; new mail shows up on restart")
+                    return
+                self.resync()
+                while True:
+                    self.handle(self.idle())
+            except (OSError, imaplib.IMAP4.abort) as e:
+                print("IDLE connection lost:", e)
+                self.service.reconnect()
+                time.sleep(IDLE_RETRY)
+
+    def resync(self):
+        #Reports changes since the listener last looked (e.g. while the
+        #connection was down). Without QRESYNC, this means rebuilding the
+        #sequence number -> UID map from a list of every UID
+        if self.service.qresync and self.uids is None:
+            if self.modseq is not None:
+                changes = self.service.sync_changes(self.mailbox, self.last_uid, self.modseq)
+            else:
+                #Nothing to compare with, so only new mail can be found
+                self.service.select(self.mailbox)
+                changes = None
+                if self.service.highest_modseq is not None:
+                    changes = (None, self.new_uids(), [])
+            if changes is not None:
+                server_msg_amt, new_uids, vanished = changes
+                new_uids = sorted(int(uid) for uid in new_uids)
+                self.modseq = self.service.highest_modseq
+                if new_uids:
+                    self.last_uid = new_uids[-1]
+                expunged = self.vanished_uids(vanished)
+                if new_uids or expunged:
+                    self.on_change(self.mailbox, new_uids, expunged)
+                return
+        uids = sorted(self.service.search(self.mailbox, "ALL"))
+        new_uids = [uid for uid in uids if uid > self.last_uid]
+        expunged = sorted(set(self.uids) - set(uids)) if self.uids is not None else []
+        self.uids = uids
+        if new_uids:
+            self.last_uid = new_uids[-1]
+        if new_uids or expunged:
+            self.on_change(self.mailbox, new_uids, expunged)
+
+    def idle(self):
+        #Issues IDLE, returning the untagged responses received before it
+        #ends: IDLE_BATCH seconds after a change, or after IDLE_RENEW seconds.
+        #Reads the socket directly, since imaplib can't wait with a timeout
+        api = self.service.api
+        self.idle_amt += 1
+        tag = b"IDLE%d" % self.idle_amt
+        api.send(tag + b" IDLE\r\n")
+        STATS.add("imap IDLE")
+        deadline = time.monotonic() + IDLE_RENEW
+        done_sent = False
+        buffer = b""
+        lines = []
         try:
-            self.smtp.sendmail(self.config["username"], to, msg.as_string())
-            return True
-        except smtplib.SMTPException as e:
-            print("Error Sending:", e)
-            return False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and not done_sent:
+                    api.send(b"DONE\r\n")
+                    done_sent = True
+                api.sock.settimeout(None if done_sent else remaining)
+                try:
+                    data = api.recv()
+                except socket.timeout:
+                    continue
+                if not data:
+                    raise imaplib.IMAP4.abort("server closed connection")
+                buffer += data
+                while b"\r\n" in buffer:
+                    line, buffer = buffer.split(b"\r\n", 1)
+                    if line.startswith(tag + b" "):
+                        if line.split()[1] != b"OK":
+                            raise imaplib.IMAP4.abort("IDLE failed: " + line.decode())
+                        return lines
+                    if line.startswith(b"* "):
+                        lines.append(line)
+                        if re.match(rb'\* (\d+ EXISTS|\d+ EXPUNGE|VANISHED)', line):
+                            deadline = min(deadline, time.monotonic() + IDLE_BATCH)
+        finally:
+            api.sock.settimeout(None)
+
+    def handle(self, lines):
+        #Turns untagged responses from idle() into new/expunged UIDs
+        has_new = False
+        expunged = []
+        for line in lines:
+            words = line.split()
+            if words[2:3] == [b"EXPUNGE"] and self.uids is not None:
+                #Later sequence numbers shift down, as in self.uids. Numbers
+                #past its end belong to messages announced by EXISTS in this
+                #batch (e.g. moved away by a filter), which are never reported
+                seq = int(words[1])
+                if seq <= len(self.uids):
+                    expunged.append(self.uids.pop(seq - 1))
+            elif words[1] == b"VANISHED":
+                #Sent instead of EXPUNGE once QRESYNC is enabled
+                gone = self.vanished_uids(seq_ranges(words[-1].decode()))
+                if self.uids is not None:
+                    self.uids = sorted(set(self.uids) - set(gone))
+                expunged += gone
+            elif words[2:3] == [b"EXISTS"] and (self.uids is None
+                                                or int(words[1]) > len(self.uids)):
+                has_new = True
+            #FETCH responses report flag changes, which the db doesn't store
+        new_uids = self.new_uids() if has_new else []
+        if self.uids is not None:
+            self.uids += new_uids
+        if new_uids:
+            self.last_uid = new_uids[-1]
+        if new_uids or expunged:
+            self.on_change(self.mailbox, new_uids, expunged)
+
+    def new_uids(self):
+        #Returns the UIDs above last_uid in the selected mailbox, in order
+        status, data = self.service.api.uid("FETCH", f"{self.last_uid+1}:*", "(UID)")
+        self.service.error_check(status, "couldn't fetch new UIDs")
+        return sorted(int(uid) for uid in re.findall(rb'UID (\d+)', b' '.join(d for d in data if d))
+                      if int(uid) > self.last_uid)
+
+    def vanished_uids(self, ranges):
+        #Returns the UIDs in VANISHED ranges that may be in the db; the
+        #ranges may also cover UIDs that were never used
+        if self.uids is not None:
+            return sorted(uid for uid in self.uids if any(a <= uid <= b for a, b in ranges))
+        return [uid for a, b in ranges for uid in range(a, min(b, self.last_uid) + 1)]
@@ -0,0 +1,260 @@
+import smtplib, email.utils, threading, time
+from email.mime.text import MIMEText
+from stats import *
+from profiler import *
+from store import *
+
+#Seconds to wait on the SMTP server before giving up on it
+SMTP_TIMEOUT = 60
+#Seconds a connection may sit unused before NOOP checks it's still open
+NOOP_AFTER = 10
+#Number of times a message is tried before it's marked failed
+SEND_ATTEMPTS = 8
+#Seconds before the 1st retry of a message; doubles with each one, up to SEND_RETRY_MAX
+SEND_RETRY_BASE = 30
+SEND_RETRY_MAX = 60 * 60
+
+def recipients(to):
+    #Returns the addresses in a To line, e.g. 'Ann <a@b.com>, c@d.com'
+    return [address for name, address in email.utils.getaddresses([to]) if address]
+
+class CountingReader:
+    """Purpose: Wraps a file read by smtplib, adding the bytes read to STATS"""
+    def __init__(self, file):
+        self.file = file
+
+    def readline(self, size=-1):
+        line = self.file.readline(size)
+        STATS.add("smtp bytes in", len(line))
+        return line
+
+    def close(self):
+        self.file.close()
+
+class MailSMTPMixin:
+    """Purpose: Adds each SMTP command's count and time (until its reply),
+        and the bytes sent and received, to STATS. Also sends messages with
+        PIPELINING when the server supports it (see send_pipelined())"""
+    #Command waiting for its reply, and when it was sent
+    command = None
+    sent = 0.0
+
+    def send(self, s):
+        STATS.add("smtp bytes out", len(s))
+        super().send(s)
+
+    def putcmd(self, cmd, args=""):
+        self.command, self.sent = cmd.upper(), time.perf_counter()
+        super().putcmd(cmd, args)
+
+    def getreply(self):
+        if self.file is None and self.sock is not None:
+            self.file = CountingReader(self.sock.makefile("rb"))
+        reply = super().getreply()
+        if self.command is not None:
+            STATS.add("smtp " + self.command, 1, time.perf_counter() - self.sent)
+            self.command = None
+        return reply
+
+    def send_pipelined(self, from_addr, to_addrs, msg):
+        #Acts like sendmail(), but if the server supports PIPELINING (RFC 2920)
+        #sends MAIL, every RCPT and DATA at once, then the message, so sending
+        #takes 2 round trips however many recipients there are
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining"):
+            return self.sendmail(from_addr, to_addrs, msg)
+        commands = (["MAIL FROM:" + smtplib.quoteaddr(from_addr)]
+                    + ["RCPT TO:" + smtplib.quoteaddr(address) for address in to_addrs]
+                    + ["DATA"])
+        self.command, self.sent = "MAIL+RCPT+DATA (pipelined)", time.perf_counter()
+        self.send("".join(command + smtplib.CRLF for command in commands))
+        replies = [self.getreply() for command in commands]
+        mail_reply, data_reply = replies[0], replies[-1]
+        refused = {address: reply for address, reply in zip(to_addrs, replies[1:-1])
+                   if reply[0] not in (250, 251)}
+        if mail_reply[0] != 250 or len(refused) == len(to_addrs) or data_reply[0] != 354:
+            if data_reply[0] == 354:
+                #Servers should refuse DATA once MAIL or every RCPT failed
+                self.send("." + smtplib.CRLF)
+                self.getreply()
+            try:
+                self.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(*mail_reply, from_addr)
+            if len(refused) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(*data_reply)
+        data = smtplib.quotedata(msg)
+        if not data.endswith(smtplib.CRLF):
+            data += smtplib.CRLF
+        self.command, self.sent = "DATA (message)", time.perf_counter()
+        self.send(data + "." + smtplib.CRLF)
+        code, resp = self.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+class MailSMTP(MailSMTPMixin, smtplib.SMTP):
+    pass
+
+class MailSMTP_SSL(MailSMTPMixin, smtplib.SMTP_SSL):
+    pass
+
+class SMTPConnection:
+    """Purpose: One logged-in SMTP connection, reused for every message sent.
+        Once it's sat unused, NOOP checks it's still open before it's reused;
+        if it isn't, it's reopened without the caller noticing"""
+    def __init__(self, config):
+        self.config = config
+        self.smtp = None
+        #time.monotonic() when the server last answered
+        self.last_used = 0.0
+
+    def connect(self):
+        host = self.config.get("smtp_host", "smtp.gmail.com")
+        with profiled("connect " + host):
+            #"smtp_ssl": false is for servers only offering STARTTLS (or none,
+            #e.g. fake ones on this machine)
+            if self.config.get("smtp_ssl", True):
+                self.smtp = MailSMTP_SSL(host, self.config.get("smtp_port", 465),
+                                         timeout=SMTP_TIMEOUT)
+            else:
+                self.smtp = MailSMTP(host, self.config.get("smtp_port", 587),
+                                     timeout=SMTP_TIMEOUT)
+                self.smtp.ehlo()
+                if self.smtp.has_extn("starttls"):
+                    self.smtp.starttls()
+                    self.smtp.ehlo()
+            try:
+                self.smtp.ehlo_or_helo_if_needed()
+                if self.smtp.has_extn("auth"):
+                    self.smtp.login(self.config["username"], self.config["password"])
+            except smtplib.SMTPException:
+                self.close()
+                raise
+        self.last_used = time.monotonic()
+        print("Logged in to SMTP")
+
+    def alive(self):
+        if self.smtp is None:
+            return False
+        if time.monotonic() - self.last_used < NOOP_AFTER:
+            return True
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, from_addr, to_addrs, msg):
+        #Returns the recipients the server refused, like SMTP.sendmail()
+        reused = self.alive()
+        if not reused:
+            self.close()
+        #A reused connection may have dropped since it was checked; if so,
+        #a new one gets one more try
+        for retry in (reused, False):
+            if self.smtp is None:
+                self.connect()
+            try:
+                refused = self.smtp.send_pipelined(from_addr, to_addrs, msg)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                #The server answered, so the connection can be kept
+                self.last_used = time.monotonic()
+                raise
+            except OSError:
+                #smtplib's other errors (e.g. SMTPServerDisconnected) are OSErrors too
+                self.close()
+                if not retry:
+                    raise
+                continue
+            self.last_used = time.monotonic()
+            return refused
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+class OutboxSender(threading.Thread):
+    """Purpose: Sends the messages in the outbox table on a background thread,
+        over one reused SMTP connection, so sending never blocks the Tk main
+        loop. Failures are retried with backoff. Posts ("sending" | "sent" |
+        "send_retry" | "send_failed", description) tuples to events"""
+    def __init__(self, events, config):
+        super().__init__(daemon=True)
+        self.events = events
+        self.config = config
+        #Set by notify() to send newly queued messages right away
+        self.wake = threading.Event()
+
+    def notify(self):
+        #Called (on any thread) after a message is queued and committed
+        self.wake.set()
+
+    def run(self):
+        #Created here; sqlite connections can't be shared across threads
+        self.store = Store("mail.db", self.config)
+        self.smtp = SMTPConnection(self.config)
+        #Messages left queued when the app last closed are sent first
+        while True:
+            self.wake.clear()
+            self.wake.wait(self.send_due())
+
+    def send_due(self):
+        #Sends every message due to be (re)tried; returns the seconds until
+        #the next retry, or None if no message is waiting for one
+        rows = self.store.db.execute("SELECT id, recipient, subject, message_text, message_id,"
+                                     + " attempts FROM outbox WHERE NOT failed"
+                                     + " AND next_try <= ? ORDER BY id",
+                                     (time.time(),)).fetchall()
+        for row in rows:
+            self.send(*row)
+        (next_try,) = self.store.db.execute("SELECT MIN(next_try) FROM outbox"
+                                            + " WHERE NOT failed").fetchone()
+        if next_try is None:
+            return None
+        return max(next_try - time.time(), 0)
+
+    def send(self, id_, to, subject, text, message_id, attempts):
+        msg = MIMEText(text)
+        msg["To"], msg["From"], msg["Subject"] = to, self.config["username"], subject
+        msg["Date"] = email.utils.formatdate(localtime=True)
+        msg["Message-ID"] = message_id
+        description = '"' + subject + '"'
+        self.events.put(("sending", description))
+        try:
+            refused = self.smtp.send(self.config["username"], recipients(to), msg.as_string())
+        except (smtplib.SMTPException, OSError, UnicodeError) as e:
+            self.failed(id_, description, attempts + 1, e)
+            return
+        self.store.cursor.execute("DELETE FROM outbox WHERE id = ?", (id_,))
+        self.store.commit()
+        if refused:
+            print("Warning:", description, "wasn't sent to", ", ".join(refused))
+        self.events.put(("sent", description))
+
+    def failed(self, id_, description, attempts, error):
+        #Errors the server says are permanent (5xx replies) aren't retried;
+        #the message stays in the outbox, marked failed
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            code = min(code for code, resp in error.recipients.values())
+        else:
+            code = getattr(error, "smtp_code", None)
+        permanent = isinstance(error, UnicodeError) or (code is not None and code >= 500) \
+                    or attempts >= SEND_ATTEMPTS
+        delay = min(SEND_RETRY_BASE * 2 ** (attempts - 1), SEND_RETRY_MAX)
+        self.store.cursor.execute("UPDATE outbox SET attempts = ?, next_try = ?, error = ?,"
+                                  + " failed = ? WHERE id = ?",
+                                  (attempts, int(time.time() + delay), str(error), permanent, id_))
+        self.store.commit()
+        print("Error sending", description + ":", error)
+        if permanent:
+            self.events.put(("send_failed", description))
+        else:
+            self.events.put(("send_retry", f"{description} (retrying in {delay}s)"))
@@ -0,0 +1,75 @@
+import os, hashlib, mmap, threading
+
+#Size after which a new pack file is started; keeps each one easy to mmap
+PACK_SIZE = 256 * 1024 * 1024
+#Pack files are shared by every thread's PackStore; one appends at a time
+PACK_LOCK = threading.Lock()
+
+class PackStore:
+    """Purpose: Keeps raw RFC822 messages in append-only pack files next to the
+        db, indexed by hash in the db's packed table, so a message found in
+        several mailboxes is stored once and can be re-parsed without the server"""
+    def __init__(self, directory, db):
+        self.directory = directory
+        #The db connection of the thread using this object
+        self.db = db
+        #Number of the pack being appended to; found on first add()
+        self.current = None
+        self.file = None
+        #Whether anything was written since the last flush()
+        self.dirty = False
+        #Read-only maps of pack files, by pack number
+        self.maps = {}
+
+    def path(self, pack):
+        return os.path.join(self.directory, f"{pack:05}.pack")
+
+    def add(self, raw):
+        #Stores raw (unless identical bytes are already stored); returns its hash
+        hash_ = hashlib.sha256(raw).hexdigest()
+        if self.db.execute("SELECT 1 FROM packed WHERE hash = ?", (hash_,)).fetchone():
+            return hash_
+        with PACK_LOCK:
+            if self.file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                packs = [int(name.split(".")[0]) for name in os.listdir(self.directory)
+                         if name.endswith(".pack")]
+                self.current = max(packs, default=0)
+                self.file = open(self.path(self.current), "ab", buffering=0)
+            #Other threads may have appended or started new packs since
+            while os.path.getsize(self.path(self.current)) >= PACK_SIZE:
+                self.file.close()
+                self.current += 1
+                self.file = open(self.path(self.current), "ab", buffering=0)
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(raw)
+        self.dirty = True
+        self.db.execute("INSERT OR IGNORE INTO packed VALUES (?,?,?,?)",
+                        (hash_, self.current, offset, len(raw)))
+        return hash_
+
+    def get(self, hash_):
+        #Returns the raw message as a memoryview into the pack file, or None
+        row = self.db.execute("SELECT pack, offset, length FROM packed WHERE hash = ?",
+                              (hash_,)).fetchone()
+        if row is None:
+            return None
+        pack, offset, length = row
+        if pack not in self.maps or len(self.maps[pack]) < offset + length:
+            #Not mapped yet, or the pack has grown since; any views into the
+            #old map keep it alive until they're gone
+            with open(self.path(pack), "rb") as pack_file:
+                self.maps[pack] = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.maps[pack])[offset:offset + length]
+
+    def flush(self):
+        #Makes appended messages durable; called before the db commits
+        #rows pointing at them
+        if self.dirty:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,97 @@
+import os, re, time, threading, contextlib, cProfile, tracemalloc
+
+#Number of lines with the most allocations listed for each phase
+TOP_AMT = 25
+#Allocations made by profiling itself aren't reported
+ALLOCATION_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+                      tracemalloc.Filter(False, cProfile.__file__),
+                      tracemalloc.Filter(False, __file__)]
+
+class Profiler:
+    """Purpose: Profiles named phases of the app (see profiled()), writing a
+        cProfile .pstats file and a tracemalloc report of the lines that
+        allocated the most for each one to directory"""
+    def __init__(self, directory, top_amt=TOP_AMT):
+        self.directory = directory
+        self.top_amt = top_amt
+        os.makedirs(directory, exist_ok=True)
+        #Numbers the files in the order phases started
+        self.lock = threading.Lock()
+        self.phase_amt = 0
+        #Profiles of the phases running on each thread, innermost last; only
+        #the innermost one runs, so a phase's profile excludes nested phases
+        self.local = threading.local()
+        #Ident of the thread whose phases cProfile is profiling, if any. Only
+        #one profiler may be enabled at a time (Python 3.12+ raises otherwise),
+        #so phases that overlap it on other threads are only timed
+        self.owner = None
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        thread = threading.get_ident()
+        with self.lock:
+            self.phase_amt += 1
+            number = self.phase_amt
+            if self.owner is None:
+                self.owner = thread
+            profile = cProfile.Profile() if self.owner == thread else None
+        stack = self.local.__dict__.setdefault("stack", [])
+        if profile is not None:
+            if stack:
+                stack[-1].disable()
+            stack.append(profile)
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            seconds = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            if profile is not None:
+                stack.pop()
+                if stack:
+                    stack[-1].enable()
+                else:
+                    with self.lock:
+                        self.owner = None
+            self.write(number, name, profile, seconds, before, after)
+
+    def write(self, number, name, profile, seconds, before, after):
+        path = os.path.join(self.directory, f"{number:04}-" + re.sub(r'[^\w.-]+', "_", name))
+        if profile is not None:
+            profile.dump_stats(path + ".pstats")
+        allocations = after.filter_traces(ALLOCATION_FILTERS).compare_to(
+            before.filter_traces(ALLOCATION_FILTERS), "lineno")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path + ".allocs.txt", "w") as report:
+            report.write(f"{name}: {seconds:.3f} seconds; {current:,} bytes traced"
+                         + f" afterwards, peak {peak:,}\n")
+            if profile is None:
+                report.write("No .pstats: a phase on another thread was being profiled\n")
+            #tracemalloc can't tell threads apart
+            report.write("Includes allocations by other threads running meanwhile\n\n")
+            for allocation in allocations[:self.top_amt]:
+                report.write(str(allocation) + "\n")
+        print("Profiled", name, f"({seconds:.3f}s):", path + (".pstats" if profile is not None
+                                                               else ".allocs.txt"))
+
+#Set by start_profiling() (mail.py --profile); phases aren't profiled while None
+PROFILER = None
+
+def start_profiling(directory, top_amt=TOP_AMT):
+    global PROFILER
+    PROFILER = Profiler(directory, top_amt)
+
+@contextlib.contextmanager
+def profiled(name):
+    #Profiles the with block as a phase called name, if profiling was started
+    if PROFILER is None:
+        yield
+        return
+    with PROFILER.phase(name):
+        yield
@@ -0,0 +1,136 @@
+import html.parser
+from store import *
+
+#Bump when render_html()'s output changes, so cached renderings are redone
+RENDERER_VERSION = 1
+#Tags whose content isn't shown
+SKIP_TAGS = {"script", "style", "head", "title", "template"}
+#Tags that start and end a paragraph (blank line before and after)
+PARAGRAPH_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "table",
+                  "blockquote", "pre", "hr", "dl", "form"}
+#Tags that start and end a line
+LINE_TAGS = {"div", "li", "tr", "dt", "dd", "section", "article", "header",
+             "footer", "nav", "aside", "main", "address", "figure", "caption"}
+
+class HTMLRenderer(html.parser.HTMLParser):
+    """Purpose: Turns HTML into readable plain text, noting where each link is
+        (see render_html())"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        #Pieces of output text, and their total length
+        self.parts = []
+        self.length = 0
+        #[start, end, url] of each link in the output
+        self.links = []
+        #URL of the <a> being read, and where its text starts (once known)
+        self.href = None
+        self.link_start = None
+        #How deep inside tags that are skipped/<pre> the parser is
+        self.skipping = 0
+        self.pre = 0
+        #Newlines at the end of the output; starts as if after a paragraph,
+        #so the text doesn't begin with blank lines
+        self.newlines = 2
+        #Whether whitespace was seen since the last text written
+        self.space = False
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def line_break(self, newlines):
+        #Ends the current line, leaving at least newlines newlines
+        if self.newlines < newlines:
+            self.write("\n" * (newlines - self.newlines))
+            self.newlines = newlines
+        self.space = False
+
+    def add_text(self, text):
+        #Writes text as-is, opening the current link if it's the first in it
+        if self.space and not self.newlines:
+            self.write(" ")
+        if self.href is not None and self.link_start is None:
+            self.link_start = self.length
+        self.write(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skipping += 1
+        elif tag in PARAGRAPH_TAGS:
+            self.line_break(2)
+        elif tag in LINE_TAGS:
+            self.line_break(1)
+        elif tag == "br":
+            self.write("\n")
+            self.newlines += 1
+            self.space = False
+        elif tag in ("td", "th"):
+            self.space = True
+        if tag == "pre":
+            self.pre += 1
+        elif tag == "hr":
+            self.write("-" * 40)
+            self.line_break(2)
+        elif tag == "li":
+            self.add_text("* ")
+            self.newlines = 0
+        elif tag == "a":
+            self.href = dict(attrs).get("href")
+            self.link_start = None
+        elif tag == "img":
+            alt = (dict(attrs).get("alt") or "").strip()
+            if alt:
+                self.handle_data("[" + alt + "]")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ("br", "hr", "img"):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in PARAGRAPH_TAGS:
+            self.line_break(2)
+        elif tag in LINE_TAGS:
+            self.line_break(1)
+        if tag == "pre":
+            self.pre = max(self.pre - 1, 0)
+        elif tag == "a":
+            if self.href and self.link_start is not None:
+                self.links.append([self.link_start, self.length, self.href])
+            self.href = None
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.pre:
+            self.add_text(data)
+            self.newlines = len(data) - len(data.rstrip("\n")) if data.strip("\n") \
+                            else self.newlines + len(data)
+            return
+        if data[:1].isspace():
+            self.space = True
+        words = data.split()
+        if words:
+            self.add_text(" ".join(words))
+            self.newlines = 0
+            self.space = data[-1].isspace()
+
+def render_html(markup):
+    #Returns (text, links) for an HTML body: readable text, and the
+    #[start, end, url] of each link in it (including bare URLs), in order
+    renderer = HTMLRenderer()
+    renderer.feed(markup)
+    renderer.close()
+    text = "".join(renderer.parts).rstrip()
+    links = [link for link in renderer.links if link[0] < len(text)]
+    #URLs written out in the text, unless they're already the text of a link
+    for start, end in find_links(text):
+        if not any(link[0] < end and start < link[1] for link in renderer.links):
+            links.append([start, end, text[start:end].strip().strip("<>()")])
+    return text, sorted(links)
+
+def render_bodies(bodies):
+    #Renders (id, HTML) bodies; returns (id, text, links) for each
+    return [(id_,) + render_html(markup) for id_, markup in bodies]
@@ -0,0 +1,41 @@
+import threading, time, contextlib
+
+class Stats:
+    """Purpose: Counts and times what the app spends its time on (IMAP/SMTP
+        commands and bytes, SQL statements, parsing), across every thread.
+        Shown by mail.py --stats"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        #[count, seconds] by name, e.g. "imap UID FETCH" or "sql SELECT";
+        #for byte counters, the count is the number of bytes
+        self.counters = {}
+
+    def add(self, name, amount=1, seconds=0.0):
+        with self.lock:
+            counter = self.counters.setdefault(name, [0, 0.0])
+            counter[0] += amount
+            counter[1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        #Counts the with block once, adding the time it took
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, 1, time.perf_counter() - start)
+
+    def snapshot(self):
+        #Returns {name: (count, seconds)}
+        with self.lock:
+            return {name: tuple(counter) for name, counter in self.counters.items()}
+
+    def report(self):
+        #Returns the counters as a table, grouped by kind (imap, sql, ...)
+        lines = [f"{'':<32}{'count':>12}{'seconds':>12}"]
+        for name, (count, seconds) in sorted(self.snapshot().items()):
+            lines.append(f"{name:<32}{count:>12,}" + (f"{seconds:>12.3f}" if seconds else ""))
+        return "\n".join(lines)
+
+#Shared by everything in the process
+STATS = Stats()
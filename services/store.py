@@ -0,0 +1,450 @@
+import sqlite3, time, zlib, collections, os, datetime, email.utils, re, json
+from packs import *
+from threads import *
+from stats import *
+
+#URLs in message text, which the message view makes clickable
+LINK_PATTERN = re.compile(r'<?https?://[^\s]+>?')
+#Max size of a zlib preset dictionary
+DICT_SIZE = 32 * 1024
+#Number of recent bodies a dictionary is trained on
+DICT_SAMPLE_AMT = 2000
+
+def create_tables(db_cursor):
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, UID INT,"
+                      + " label VARCHAR, date INT, sender VARCHAR,"
+                      + " recipient VARCHAR, subject VARCHAR,"
+                      + " type VARCHAR, message_text VARCHAR)")
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS drafts (id INTEGER PRIMARY KEY,"
+                      + " recipient VARCHAR, subject VARCHAR,"
+                      + " message_text VARCHAR)")
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS config (key VARCHAR, value INT)")
+
+def add_header_columns(db_cursor):
+    #Needed for headers-only syncing; some unversioned databases already have them
+    columns = [row[1] for row in db_cursor.execute("PRAGMA table_info(messages)")]
+    if "size" not in columns:
+        db_cursor.execute("ALTER TABLE messages ADD COLUMN size INT")
+        db_cursor.execute("ALTER TABLE messages ADD COLUMN message_id VARCHAR")
+
+def add_message_indexes(db_cursor):
+    #Older versions could store a message twice; keep the first copy
+    db_cursor.execute("DELETE FROM messages WHERE id NOT IN"
+                      + " (SELECT MIN(id) FROM messages GROUP BY label, uid)")
+    db_cursor.execute("CREATE UNIQUE INDEX messages_label_uid ON messages (label, uid)")
+    db_cursor.execute("CREATE INDEX messages_label_date ON messages (label, date)")
+
+def add_search_index(db_cursor):
+    #Full-text index over messages; triggers keep it in sync with the table.
+    #Prefix indexes make searching for partly-typed words fast
+    db_cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(subject, sender,"
+                      + " recipient, message_text, content='messages', content_rowid='id',"
+                      + " prefix='2 3')")
+    db_cursor.execute("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " VALUES (new.id, new.subject, new.sender, new.recipient, new.message_text);"
+                      + " END")
+    db_cursor.execute("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) VALUES ('delete', old.id, old.subject,"
+                      + " old.sender, old.recipient, old.message_text);"
+                      + " END")
+    db_cursor.execute("CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) VALUES ('delete', old.id, old.subject,"
+                      + " old.sender, old.recipient, old.message_text);"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " VALUES (new.id, new.subject, new.sender, new.recipient, new.message_text);"
+                      + " END")
+    db_cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def add_mailboxes_table(db_cursor):
+    #Names of the mailboxes on the server, as of the last sync
+    db_cursor.execute("CREATE TABLE mailboxes (name VARCHAR PRIMARY KEY)")
+
+def compress_bodies(db_cursor):
+    #Moves message text into its own table, zlib-compressed, so the messages
+    #table (scanned to list mail) stays small. The search index now reads
+    #bodies through the body_text() function that Store registers
+    for trigger in ("insert", "delete", "update"):
+        db_cursor.execute(f"DROP TRIGGER messages_fts_{trigger}")
+    db_cursor.execute("DROP TABLE messages_fts")
+    #Shared dictionaries some bodies are compressed with (see train_dictionary())
+    db_cursor.execute("CREATE TABLE dictionaries (id INTEGER PRIMARY KEY, data BLOB)")
+    db_cursor.execute("CREATE TABLE bodies (id INTEGER PRIMARY KEY, dict INT, data BLOB)")
+    #Read on a second cursor, so bodies are streamed rather than all loaded
+    rows = db_cursor.connection.execute("SELECT id, message_text FROM messages"
+                                        + " WHERE message_text IS NOT NULL")
+    db_cursor.executemany("INSERT INTO bodies VALUES (?, NULL, ?)",
+                          ((id_, zlib.compress(text.encode())) for id_, text in rows))
+    db_cursor.execute("UPDATE messages SET message_text = NULL")
+    db_cursor.execute("CREATE VIEW message_texts AS SELECT messages.id AS id, subject, sender,"
+                      + " recipient, body_text(dict, data) AS message_text FROM messages"
+                      + " LEFT JOIN bodies ON bodies.id = messages.id")
+    db_cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(subject, sender,"
+                      + " recipient, message_text, content='message_texts', content_rowid='id',"
+                      + " prefix='2 3')")
+    #A new message has no body yet; it's indexed when its body is added
+    db_cursor.execute("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient)"
+                      + " VALUES (new.id, new.subject, new.sender, new.recipient);"
+                      + " END")
+    db_cursor.execute("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) VALUES ('delete', old.id, old.subject,"
+                      + " old.sender, old.recipient,"
+                      + " (SELECT body_text(dict, data) FROM bodies WHERE id = old.id));"
+                      + " DELETE FROM bodies WHERE id = old.id;"
+                      + " END")
+    db_cursor.execute("CREATE TRIGGER messages_fts_update AFTER UPDATE OF subject, sender,"
+                      + " recipient ON messages BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) SELECT 'delete', old.id, old.subject,"
+                      + " old.sender, old.recipient, message_text FROM message_texts"
+                      + " WHERE id = old.id;"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " SELECT id, subject, sender, recipient, message_text FROM message_texts"
+                      + " WHERE id = new.id;"
+                      + " END")
+    #Bodies are only ever added (see Store.add_body()), replacing the entry
+    #made without one
+    db_cursor.execute("CREATE TRIGGER bodies_fts_insert AFTER INSERT ON bodies BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient) SELECT 'delete', id, subject, sender, recipient"
+                      + " FROM messages WHERE id = new.id;"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " SELECT id, subject, sender, recipient, body_text(new.dict, new.data)"
+                      + " FROM messages WHERE id = new.id;"
+                      + " END")
+    db_cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def add_raw_messages(db_cursor):
+    #Where each raw message is in the pack files (see PackStore), by SHA-256
+    #hash of its bytes; only filled in "archive" sync mode
+    db_cursor.execute("CREATE TABLE packed (hash VARCHAR PRIMARY KEY, pack INT, offset INT,"
+                      + " length INT)")
+    db_cursor.execute("ALTER TABLE messages ADD COLUMN raw_hash VARCHAR")
+    #Re-parsing a raw message may replace its body
+    db_cursor.execute("CREATE TRIGGER bodies_fts_update AFTER UPDATE ON bodies BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) SELECT 'delete', id, subject, sender,"
+                      + " recipient, body_text(old.dict, old.data) FROM messages WHERE id = old.id;"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " SELECT id, subject, sender, recipient, body_text(new.dict, new.data)"
+                      + " FROM messages WHERE id = new.id;"
+                      + " END")
+
+def date_to_epoch(value):
+    #Older versions stored dates as ctime() strings (in the sender's time
+    #zone, which was dropped), or as the Date header if it looked unusual
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, str):
+        #Unknown dates sort as oldest
+        return 0
+    try:
+        date = datetime.datetime.strptime(value, "%a %b %d %H:%M:%S %Y")
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return 0
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+def convert_dates(db_cursor):
+    #Dates are now seconds since the epoch, so they sort chronologically
+    db_cursor.connection.create_function("date_to_epoch", 1, date_to_epoch)
+    db_cursor.execute("UPDATE messages SET date = date_to_epoch(date)"
+                      + " WHERE typeof(date) != 'integer'")
+
+def add_threads(db_cursor):
+    #Conversations (see thread_msgs()), per mailbox. date is the newest
+    #message's, started the oldest's; subject is taken from the oldest message
+    db_cursor.execute("CREATE TABLE threads (id INTEGER PRIMARY KEY, label VARCHAR, date INT,"
+                      + " started INT, subject VARCHAR, msg_amt INT)")
+    db_cursor.execute("CREATE INDEX threads_label_date ON threads (label, date)")
+    #Every Message-ID seen in a mailbox, including ones only referenced by
+    #replies, and the thread it belongs to (like JWZ's empty containers)
+    db_cursor.execute("CREATE TABLE thread_ids (label VARCHAR, message_id VARCHAR,"
+                      + " thread_id INT, PRIMARY KEY (label, message_id)) WITHOUT ROWID")
+    #For merging threads
+    db_cursor.execute("CREATE INDEX thread_ids_thread ON thread_ids (thread_id)")
+    db_cursor.execute("ALTER TABLE messages ADD COLUMN refs VARCHAR")
+    db_cursor.execute("ALTER TABLE messages ADD COLUMN thread_id INT")
+    db_cursor.execute("CREATE INDEX messages_thread ON messages (thread_id, date)")
+    #Threads whose messages are all deleted are kept (with msg_amt 0), so
+    #late replies still join them
+    db_cursor.execute("CREATE TRIGGER messages_thread_delete AFTER DELETE ON messages BEGIN"
+                      + " UPDATE threads SET msg_amt = msg_amt - 1,"
+                      + " date = COALESCE((SELECT MAX(date) FROM messages"
+                      + " WHERE thread_id = old.thread_id), 0)"
+                      + " WHERE id = old.thread_id;"
+                      + " END")
+    #Existing messages have no References stored; each starts its own thread
+    rethread(db_cursor)
+
+def add_link_spans(db_cursor):
+    #(start, end) offsets of the links in each body, as JSON; found when the
+    #body is stored, or the first time older ones are shown
+    db_cursor.execute("ALTER TABLE bodies ADD COLUMN links VARCHAR")
+    #Saving the links of a body mustn't reindex it
+    db_cursor.execute("DROP TRIGGER bodies_fts_update")
+    db_cursor.execute("CREATE TRIGGER bodies_fts_update AFTER UPDATE OF dict, data ON bodies BEGIN"
+                      + " INSERT INTO messages_fts (messages_fts, rowid, subject, sender,"
+                      + " recipient, message_text) SELECT 'delete', id, subject, sender,"
+                      + " recipient, body_text(old.dict, old.data) FROM messages WHERE id = old.id;"
+                      + " INSERT INTO messages_fts (rowid, subject, sender, recipient, message_text)"
+                      + " SELECT id, subject, sender, recipient, body_text(new.dict, new.data)"
+                      + " FROM messages WHERE id = new.id;"
+                      + " END")
+
+def add_rendered_cache(db_cursor):
+    #HTML bodies turned into text (see render_html()), compressed like bodies,
+    #with [start, end, url] link spans; version is the renderer's, and rows
+    #made by an older one are rendered again
+    db_cursor.execute("CREATE TABLE rendered (id INTEGER PRIMARY KEY, version INT, dict INT,"
+                      + " data BLOB, links VARCHAR)")
+    db_cursor.execute("CREATE TRIGGER messages_rendered_delete AFTER DELETE ON messages BEGIN"
+                      + " DELETE FROM rendered WHERE id = old.id;"
+                      + " END")
+    #e.g. after reindexing
+    db_cursor.execute("CREATE TRIGGER bodies_rendered_update AFTER UPDATE OF dict, data ON bodies"
+                      + " BEGIN DELETE FROM rendered WHERE id = old.id;"
+                      + " END")
+
+def add_outbox(db_cursor):
+    #Messages waiting for an OutboxSender; next_try is when (in epoch seconds)
+    #to try sending again, and failed is set once it gives up
+    db_cursor.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY, recipient VARCHAR,"
+                      + " subject VARCHAR, message_text VARCHAR, message_id VARCHAR,"
+                      + " queued INT, attempts INT DEFAULT 0, next_try INT DEFAULT 0,"
+                      + " error VARCHAR, failed INT DEFAULT 0)")
+
+def find_links(text):
+    #Returns the (start, end) offsets of the URLs in text, in order
+    return [match.span() for match in LINK_PATTERN.finditer(text)]
+
+def train_dictionary(texts, size=DICT_SIZE):
+    #Builds a zlib preset dictionary from the lines (e.g. signatures, footers)
+    #and words most common in texts. zlib refers back to it like to earlier
+    #text, and nearer matches are cheaper, so the most common strings go last
+    lines = collections.Counter(line for text in texts for line in set(text.splitlines())
+                                if len(line.strip()) > 3)
+    words = collections.Counter(word for text in texts for word in set(text.split())
+                                if len(word) > 3)
+    strings = [line for line, count in lines.most_common() if count > 1]
+    strings += [word for word, count in words.most_common() if count > 1]
+    dictionary = b""
+    for string in strings:
+        string = (string + "\n").encode()
+        if len(dictionary) + len(string) > size:
+            break
+        dictionary = string + dictionary
+    return dictionary
+
+def search_query(text):
+    #Turns what the user typed into an FTS5 query matching messages that
+    #contain every word (or a word starting with it, if 2+ chars long)
+    return " ".join('"' + word.replace('"', '""') + ('"*' if len(word) > 1 else '"')
+                    for word in text.split())
+
+#Each function upgrades the db schema by one version; the db's current
+#version is stored in PRAGMA user_version
+MIGRATIONS = [create_tables, add_header_columns, add_message_indexes, add_search_index,
+              add_mailboxes_table, compress_bodies, add_raw_messages,
+              convert_dates, add_threads, add_link_spans, add_rendered_cache, add_outbox]
+
+def upgrade_db(db_cursor):
+    #Creates the db's tables or migrates them from an older version;
+    #returns the version the db had before
+    (version,) = db_cursor.execute("PRAGMA user_version").fetchone()
+    for new_version, migrate in enumerate(MIGRATIONS[version:], version+1):
+        migrate(db_cursor)
+        db_cursor.execute(f"PRAGMA user_version = {new_version}")
+        print("Database upgraded to version", new_version)
+    return version
+
+class CountingCursor(sqlite3.Cursor):
+    """Purpose: Adds the count and time of each SQL statement, by kind (e.g.
+        "sql SELECT"), to STATS; time spent fetching its rows is added too"""
+    kind = None
+
+    def execute(self, sql, parameters=()):
+        self.kind = "sql " + sql.split(None, 1)[0].upper()
+        with STATS.timed(self.kind):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.kind = "sql " + sql.split(None, 1)[0].upper() + " (many)"
+        with STATS.timed(self.kind):
+            return super().executemany(sql, seq_of_parameters)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        STATS.add(self.kind, 0, time.perf_counter() - start)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        STATS.add(self.kind, 0, time.perf_counter() - start)
+        return rows
+
+class CountingConnection(sqlite3.Connection):
+    """Purpose: A connection whose statements all run on CountingCursors"""
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class Store:
+    """Purpose: The local sqlite database; commits writes in bounded batches
+        so a crash during a long sync loses little work"""
+    def __init__(self, path, config):
+        #Tuning knobs come from the optional "db" section of config.json
+        db_config = config.get("db", {})
+        #Max number of written rows and max seconds between commits
+        self.commit_every = db_config.get("commit_every", 1000)
+        self.commit_interval = db_config.get("commit_interval_ms", 1000) / 1000
+        #Several sync threads may write at once; wait for each other's commits
+        self.db = sqlite3.connect(path, timeout=60, factory=CountingConnection)
+        #WAL lets readers keep going while a sync is writing
+        self.db.execute(f"PRAGMA journal_mode = {db_config.get('journal_mode', 'wal')}")
+        self.db.execute(f"PRAGMA synchronous = {db_config.get('synchronous', 'normal')}")
+        #Negative values are in KiB rather than pages
+        self.db.execute(f"PRAGMA cache_size = {-int(db_config.get('cache_size_kb', 20000))}")
+        #zlib level used for message bodies (1 is fastest, 9 smallest)
+        self.compress_level = db_config.get("compress_level", 6)
+        #Whether to train a shared dictionary for compressing bodies
+        self.use_dictionary = db_config.get("zlib_dictionary", False)
+        self.dictionaries = {}
+        self.dictionary_id = None
+        #Used by the search index's triggers to read compressed bodies
+        self.db.create_function("body_text", 2, self.body_text, deterministic=True)
+        self.cursor = self.db.cursor()
+        old_version = upgrade_db(self.cursor)
+        self.db.commit()
+        if 0 < old_version < MIGRATIONS.index(compress_bodies) + 1:
+            #Give back the space freed by compressing existing bodies
+            print("Compacting database")
+            self.db.execute("VACUUM")
+        self.load_dictionaries()
+        #Raw messages, kept in a folder beside the db
+        self.packs = PackStore(os.path.join(os.path.dirname(os.path.abspath(path)), "packs"),
+                               self.db)
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+
+    def wrote(self, row_amt):
+        #Records that row_amt rows were written, committing if a batch is full;
+        #returns True if it committed
+        self.uncommitted += row_amt
+        if self.due():
+            self.commit()
+            return True
+        return False
+
+    def due(self, row_amt=0):
+        #Whether writing row_amt more rows fills the batch, or the batch has
+        #been open for commit_interval
+        return self.uncommitted + row_amt >= self.commit_every \
+               or time.monotonic() - self.last_commit >= self.commit_interval
+
+    def commit(self):
+        self.packs.flush()
+        self.db.commit()
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+
+    def load_dictionaries(self):
+        for id_, data in self.db.execute("SELECT id, data FROM dictionaries"):
+            self.dictionaries[id_] = data
+            #New bodies use the newest dictionary
+            self.dictionary_id = id_
+
+    def compress(self, text):
+        #Returns (dictionary id or None, compressed text) for storing a body
+        if self.dictionary_id is None:
+            return None, zlib.compress(text.encode(), self.compress_level)
+        compressor = zlib.compressobj(self.compress_level,
+                                      zdict=self.dictionaries[self.dictionary_id])
+        return self.dictionary_id, compressor.compress(text.encode()) + compressor.flush()
+
+    def pack_body(self, text):
+        #Returns the (dict, data, links) columns of the bodies table for text
+        return self.compress(text) + (json.dumps(find_links(text)),)
+
+    def body_text(self, dict_id, data):
+        #Undoes compress(); None if the body hasn't been downloaded
+        if data is None:
+            return None
+        if dict_id is None:
+            return zlib.decompress(data).decode()
+        if dict_id not in self.dictionaries:
+            #Trained by another connection since this one loaded them
+            self.load_dictionaries()
+        decompressor = zlib.decompressobj(zdict=self.dictionaries[dict_id])
+        return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+    def add_body(self, id_, type_, text):
+        #Stores the downloaded body of a message already in the db
+        self.cursor.execute("UPDATE messages SET type = ? WHERE id = ?", (type_, id_))
+        self.cursor.execute("INSERT OR IGNORE INTO bodies (id, dict, data, links)"
+                            + " VALUES (?,?,?,?)", (id_,) + self.pack_body(text))
+
+    def add_rendered(self, id_, version, text, links):
+        #Caches the rendering of a message's HTML body
+        self.cursor.execute("INSERT OR REPLACE INTO rendered VALUES (?,?,?,?,?)",
+                            (id_, version) + self.compress(text) + (json.dumps(links),))
+
+    def queue_msg(self, to, subject, text):
+        #Adds a message to the outbox; the Message-ID is fixed now, so retries
+        #of a message the server got but didn't confirm aren't new messages
+        self.cursor.execute("INSERT INTO outbox (recipient, subject, message_text, message_id,"
+                            + " queued) VALUES (?,?,?,?,?)",
+                            (to, subject, text, email.utils.make_msgid(), int(time.time())))
+        return self.cursor.lastrowid
+
+    def train_dictionary(self):
+        #Trains a dictionary on recent bodies if enabled and there's none yet;
+        #only bodies added afterwards use it
+        if not self.use_dictionary or self.dictionary_id is not None:
+            return
+        rows = self.db.execute("SELECT dict, data FROM bodies ORDER BY id DESC LIMIT ?",
+                               (DICT_SAMPLE_AMT,)).fetchall()
+        if len(rows) < DICT_SAMPLE_AMT:
+            return
+        dictionary = train_dictionary([self.body_text(*row) for row in rows])
+        if not dictionary:
+            return
+        self.cursor.execute("INSERT INTO dictionaries (data) VALUES (?)", (dictionary,))
+        self.commit()
+        self.load_dictionaries()
+        print("Trained a", len(dictionary), "byte dictionary for message bodies")
+
+    def mailboxes(self):
+        #Returns the known mailbox names, INBOX first
+        names = [name for (name,) in self.db.execute("SELECT name FROM mailboxes ORDER BY name")]
+        return sorted(names, key=lambda name: name.upper() != "INBOX")
+
+    def set_mailboxes(self, names):
+        #Replaces the list of mailboxes, dropping messages of deleted ones
+        self.cursor.execute("DELETE FROM mailboxes")
+        self.cursor.executemany("INSERT INTO mailboxes VALUES (?)", ((name,) for name in names))
+        for table in ("messages", "threads", "thread_ids"):
+            self.cursor.execute(f"DELETE FROM {table} WHERE label NOT IN"
+                                + " (SELECT name FROM mailboxes)")
+        self.commit()
+
+    def close(self):
+        self.commit()
+        self.packs.close()
+        self.cursor.close()
+        self.db.close()
@@ -0,0 +1,488 @@
+import threading, queue, imaplib
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from imap import *
+from store import *
+from render import *
+
+#Number of messages written to the db per executemany() during syncing
+INSERT_BATCH_SIZE = 500
+
+def reindex(store):
+    #Re-parses every message kept in the pack files (e.g. after a parser fix),
+    #without connecting to the server; returns the number of messages
+    rows = store.db.execute("SELECT id, raw_hash FROM messages"
+                            + " WHERE raw_hash IS NOT NULL").fetchall()
+    for id_, raw_hash in rows:
+        msg = parse_msg(store.packs.get(raw_hash))
+        #Keeps the date from INTERNALDATE if the Date header is unreadable
+        store.cursor.execute("UPDATE messages SET date = COALESCE(?, date), sender = ?,"
+                             + " recipient = ?, subject = ?, message_id = ?, refs = ?"
+                             + " WHERE id = ?",
+                             (msg["date"], msg["from"], msg["to"], msg["subject"],
+                              msg["message_id"], msg["refs"], id_))
+        store.cursor.execute("UPDATE bodies SET dict = ?, data = ?, links = ? WHERE id = ?",
+                             store.pack_body(msg["text"]) + (id_,))
+        if not store.cursor.rowcount:
+            store.add_body(id_, msg["type"], msg["text"])
+        else:
+            store.cursor.execute("UPDATE messages SET type = ? WHERE id = ?", (msg["type"], id_))
+        store.wrote(1)
+    #Headers may have changed which messages reply to which
+    rethread(store.cursor)
+    store.commit()
+    return len(rows)
+
+class MailboxSync:
+    """Purpose: Brings the messages of one mailbox in the db up to date with the
+        server, posting ("changed", label) to events whenever it commits"""
+    def __init__(self, service, store, label, events, pool=None):
+        #The email service protocol object (e.g. for IMAP) used to get emails
+        self.service = service
+        #The mailbox name on the server
+        self.label = label
+        #Extra connections for downloading a new mailbox in parallel (optional)
+        self.pool = pool
+        #The local database; must belong to the thread running the sync
+        self.store = store
+        self.db_cursor = store.cursor
+        #Queue of (event, label) tuples read by the UI thread
+        self.events = events
+        #Messages received but not yet written to the db (see create_msg())
+        self.pending_msgs = []
+        #In "headers" mode, bodies are only downloaded when a message is opened;
+        #see MailService.fetch_msgs() for the others
+        self.mode = self.service.config.get("sync_mode", "headers")
+
+    def sync(self):
+        #last_uid is saved only once a full download finishes, so an interrupted
+        #build_db() (with some batches already committed) is simply resumed
+        if self.get_config("last_uid") is None:
+            with profiled("build_db " + self.label):
+                self.build_db()
+        else:
+            with profiled("refresh_db " + self.label):
+                self.refresh_db()
+        self.events.put(("changed", self.label))
+
+    def create_msg(self, msg):
+        #Callback passed to MailService.show_msgs(); adds new msgs to database
+        #in batches. Messages already in the db are skipped. Batches end early
+        #when the Store is due to commit, so its limits hold
+        self.pending_msgs.append(msg)
+        if len(self.pending_msgs) >= INSERT_BATCH_SIZE or self.store.due(len(self.pending_msgs)):
+            self.flush_msgs()
+
+    def flush_msgs(self):
+        #Writes messages queued by create_msg() to the db
+        for msg in self.pending_msgs:
+            #Kept in the pack files in "archive" mode, so it can be re-parsed
+            msg["raw_hash"] = self.store.packs.add(msg["raw"]) if "raw" in msg else None
+        self.db_cursor.executemany("INSERT INTO messages (uid, label, date, sender, recipient,"
+                                   + " subject, type, size, message_id, refs, raw_hash)"
+                                   + " VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+                                   + " ON CONFLICT (label, uid) DO NOTHING",
+                                   ((msg["uid"], self.label, msg["date"], msg["from"],
+                                     msg["to"], msg["subject"], msg["type"], msg["size"],
+                                     msg["message_id"], msg["refs"], msg["raw_hash"])
+                                    for msg in self.pending_msgs))
+        #Messages that were already in the db keep their thread
+        new_msgs = []
+        for msg in self.pending_msgs:
+            id_, thread_id = self.db_cursor.execute("SELECT id, thread_id FROM messages"
+                                                    + " WHERE label = ? AND uid = ?",
+                                                    (self.label, msg["uid"])).fetchone()
+            if thread_id is None:
+                new_msgs.append((id_, msg["date"], msg["subject"], msg["message_id"],
+                                 msg["refs"]))
+        thread_msgs(self.db_cursor, self.label, new_msgs)
+        #Bodies (if downloaded) go in their own table, compressed
+        self.db_cursor.executemany("INSERT OR IGNORE INTO bodies (id, dict, data, links)"
+                                   + " SELECT id, ?, ?, ? FROM messages"
+                                   + " WHERE label = ? AND uid = ?",
+                                   (self.store.pack_body(msg["text"]) + (self.label, msg["uid"])
+                                    for msg in self.pending_msgs if msg["text"] is not None))
+        if self.store.wrote(len(self.pending_msgs)):
+            #Committed, so the UI can now read the new rows
+            self.events.put(("changed", self.label))
+        self.pending_msgs = []
+
+    def commit_pending(self):
+        #Writes and commits everything so far. Called before waiting on the
+        #server again, so no write transaction stays open across a round trip
+        #(other connections, e.g. the UI's, would wait on it meanwhile)
+        if self.pending_msgs:
+            self.flush_msgs()
+        if self.store.db.in_transaction:
+            self.store.commit()
+            self.events.put(("changed", self.label))
+
+    def get_config(self, key):
+        #Returns the value stored in the config table for this mailbox, or None
+        row = self.db_cursor.execute("SELECT value FROM config WHERE key = ?",
+                                     (key+"_"+self.label,)).fetchone()
+        return row[0] if row else None
+
+    def set_config(self, key, value):
+        self.db_cursor.execute("UPDATE config SET value = ? WHERE key = ?",
+                               (value, key+"_"+self.label))
+        if not self.db_cursor.rowcount:
+            self.db_cursor.execute("INSERT INTO config VALUES (?,?)", (key+"_"+self.label,
+                                                                       value))
+
+    def build_db(self):
+        #Adds all messages from current mailbox to db
+        uids = self.service.search(self.label, "ALL")
+        #Mod-sequence as of the SELECT above; lets refresh_db ask only for later changes
+        modseq = self.service.highest_modseq
+        self.last_uid, self.msg_amt = max(uids, default=None), len(uids)
+        if self.pool and self.pool.size > 1 and len(uids) > FETCH_CHUNK_SIZE:
+            self.download_parallel(uids)
+        else:
+            self.service.fetch_msgs(self.label, uids, self.create_msg, self.mode,
+                                    self.commit_pending)
+        self.flush_msgs()
+        self.set_config("last_uid", self.last_uid)
+        self.set_config("msg_amt", self.msg_amt)
+        self.set_config("modseq", modseq)
+        self.store.commit()
+
+    def download_parallel(self, uids):
+        #Splits uids into disjoint ranges fetched over several pooled
+        #connections at once. This thread stays the only db writer; the
+        #downloaders hand it each chunk of messages through a queue
+        uids = sorted(uids)
+        ranges = queue.Queue()
+        for i in range(0, len(uids), FETCH_CHUNK_SIZE):
+            ranges.put(uids[i:i+FETCH_CHUNK_SIZE])
+        msgs = queue.Queue()
+        download_amt = min(self.pool.size, ranges.qsize())
+        print("Downloading", self.label, "over", download_amt, "connections")
+        self.pool.put(self.service)
+        with ThreadPoolExecutor(download_amt) as executor:
+            downloads = [executor.submit(self.download, ranges, msgs)
+                         for i in range(download_amt)]
+            finished = 0
+            while finished < download_amt:
+                chunk = msgs.get()
+                if chunk is None:
+                    finished += 1
+                    continue
+                for msg in chunk:
+                    self.create_msg(msg)
+                if msgs.empty():
+                    #Nothing to write until more is downloaded
+                    self.commit_pending()
+        self.service = self.pool.get()
+        for download in downloads:
+            #Re-raises anything that went wrong in a downloader
+            download.result()
+
+    def download(self, ranges, msgs):
+        #Runs on a downloader thread: fetches ranges until none are left
+        service = self.pool.get()
+        try:
+            while True:
+                if STOP_SYNCING.is_set():
+                    #Raised rather than returning, so build_db() doesn't
+                    #record the mailbox as fully downloaded
+                    raise SyncStopped()
+                try:
+                    uids = ranges.get_nowait()
+                except queue.Empty:
+                    return
+                chunk = []
+                service.fetch_msgs(self.label, uids, chunk.append, self.mode)
+                msgs.put(chunk)
+        except (OSError, imaplib.IMAP4.abort):
+            #The broken connection isn't handed to the next user of the slot
+            service = MailService(self.pool.config)
+            raise
+        finally:
+            self.pool.put(service)
+            #Tells the writer this downloader is done
+            msgs.put(None)
+
+    def refresh_db(self):
+        #Updates database with changes since last sync
+        print("Database not rebuilt")
+        self.last_uid = self.get_config("last_uid")
+        self.msg_amt = self.get_config("msg_amt")
+        modseq = self.get_config("modseq")
+        changes = None
+        if modseq is not None:
+            changes = self.service.sync_changes(self.label, self.last_uid, modseq)
+        if changes is None:
+            #Server lacks QRESYNC; compare against the full list of UIDs instead
+            self.reconcile_db()
+        else:
+            #As of the SELECT the changes were asked after; the SELECTs done to
+            #download new messages may see a later one, whose changes weren't
+            #asked for
+            self.modseq = self.service.highest_modseq
+            self.apply_changes(*changes)
+        self.set_config("modseq", self.modseq)
+        self.store.commit()
+
+    def apply_changes(self, server_msg_amt, new_uids, vanished):
+        #Applies the changes reported by MailService.sync_changes()
+        if not new_uids and not vanished:
+            print("Database is synced with server")
+        else:
+            print("Database isn't synced with server")
+        if new_uids:
+            criteria = b'UID ' + b','.join(new_uids)
+            self.last_uid, msg_amt = self.service.show_msgs(self.label, criteria,
+                                                            self.create_msg,
+                                                            self.mode,
+                                                            self.commit_pending)
+            self.flush_msgs()
+        for start, end in vanished:
+            self.db_cursor.execute("DELETE FROM messages WHERE label = ? AND uid BETWEEN ? AND ?",
+                                   (self.label, start, end))
+        (client_msg_amt,) = self.db_cursor.execute("SELECT COUNT(*) FROM messages WHERE label = ?",
+                                                   (self.label,)).fetchone()
+        if client_msg_amt != server_msg_amt:
+            #Should not happen, but fall back to a full comparison rather than drift
+            print("Message counts differ after incremental sync")
+            self.reconcile_db()
+            return
+        self.msg_amt = server_msg_amt
+        self.set_config("last_uid", self.last_uid)
+        self.set_config("msg_amt", self.msg_amt)
+        print("Database now synced")
+
+    def apply_pushed(self, new_uids, expunged):
+        #Applies changes an IdleListener saw while the app was running
+        self.last_uid = self.get_config("last_uid")
+        if new_uids:
+            self.service.fetch_msgs(self.label, new_uids, self.create_msg, self.mode,
+                                    self.commit_pending)
+            self.flush_msgs()
+            self.last_uid = max(self.last_uid or 0, max(new_uids))
+        self.db_cursor.executemany("DELETE FROM messages WHERE label = ? AND uid = ?",
+                                   ((self.label, uid) for uid in expunged))
+        (self.msg_amt,) = self.db_cursor.execute("SELECT COUNT(*) FROM messages WHERE label = ?",
+                                                 (self.label,)).fetchone()
+        self.set_config("last_uid", self.last_uid)
+        self.set_config("msg_amt", self.msg_amt)
+        self.store.commit()
+        print("Added", len(new_uids), "and removed", len(expunged), "messages in", self.label)
+        self.events.put(("changed", self.label))
+
+    def reconcile_db(self):
+        #Brings database in sync by comparing it against every UID on the server.
+        #The db's own count is used, so rows lost or left over (e.g. by an
+        #incremental sync that went wrong) are found too
+        (client_msg_amt,) = self.db_cursor.execute("SELECT COUNT(*) FROM messages WHERE label = ?",
+                                                   (self.label,)).fetchone()
+        is_synced, server_msg_amt, new_msgs = self.service.sync_status(self.label,
+                                                                       self.last_uid,
+                                                                       client_msg_amt)
+        #Saved by refresh_db(); later SELECTs may see changes not looked at here
+        self.modseq = self.service.highest_modseq
+        if is_synced and not new_msgs:
+            print("Database is synced with server")
+        else:
+            print("Database isn't synced with server")
+            server_uids = self.service.get_all_uids(self.label)
+            self.db_cursor.execute("CREATE TEMP TABLE IF NOT EXISTS server_uids"
+                                   + " (uid INTEGER PRIMARY KEY)")
+            self.db_cursor.execute("DELETE FROM temp.server_uids")
+            self.db_cursor.executemany("INSERT INTO temp.server_uids VALUES (?)",
+                                       ((uid,) for uid in server_uids))
+            #Remove any messages that the server removed since last sync
+            self.db_cursor.execute("DELETE FROM messages WHERE label = ? AND uid NOT IN"
+                                   + " (SELECT uid FROM temp.server_uids)", (self.label,))
+            print("Removed", self.db_cursor.rowcount, "messages")
+            #New messages, and any older ones missing from the db
+            missing = [uid for (uid,) in self.db_cursor.execute(
+                "SELECT uid FROM temp.server_uids WHERE uid NOT IN"
+                + " (SELECT uid FROM messages WHERE label = ?)", (self.label,))]
+            self.db_cursor.execute("DELETE FROM temp.server_uids")
+            if missing:
+                #The deletes above aren't left uncommitted while downloading
+                self.commit_pending()
+                self.service.fetch_msgs(self.label, missing, self.create_msg, self.mode,
+                                        self.commit_pending)
+                self.flush_msgs()
+                self.last_uid = max(self.last_uid or 0, max(missing))
+
+            (client_msg_amt,) = self.db_cursor.execute("SELECT COUNT(*) FROM messages WHERE label = ?",
+                                                       (self.label,)).fetchone()
+            if client_msg_amt != len(server_uids):
+                #e.g. messages expunged while downloading; the next sync compares again
+                print("Message counts still differ after full comparison")
+            self.msg_amt = len(server_uids)
+            self.set_config("last_uid", self.last_uid)
+            self.set_config("msg_amt", self.msg_amt)
+            print("Database now synced")
+
+class SyncWorker(threading.Thread):
+    """Purpose: Syncs every mailbox on background threads, using their own IMAP
+        connections and db handles so the Tk main loop never waits on them.
+        Afterwards, applies changes pushed by IdleListeners as they arrive"""
+    def __init__(self, events, idle_labels=("INBOX",), config=None):
+        super().__init__(daemon=True)
+        self.events = events
+        #Passed to every MailService; read from config.json if None
+        self.config = config
+        #Mailboxes watched with IMAP IDLE once synced (one connection each)
+        self.idle_labels = idle_labels
+        #Functions (with their args) to run on this thread, in order
+        self.jobs = queue.Queue()
+        #Syncs the mailboxes concurrently; made once connected (see run())
+        self.executor = None
+
+    def run(self):
+        #Created here; sqlite connections can't be shared across threads
+        config = MailService(self.config).config
+        self.store = Store("mail.db", config)
+        #All connections this worker may open. Mailboxes are synced over
+        #them concurrently, and a new mailbox may borrow idle ones to
+        #download in parallel
+        self.pool = ServicePool(config.get("connections", 4), config)
+        self.service = self.pool.get()
+        try:
+            labels = self.service.list_mailboxes()
+        except (OSError, imaplib.IMAP4.abort, SystemExit) as e:
+            #e.g. no network, or the server couldn't be found
+            print("Error: couldn't list mailboxes:", e)
+            self.events.put(("failed", None))
+            return
+        self.store.set_mailboxes(labels)
+        self.events.put(("mailboxes", None))
+        #Mailboxes the user is most likely to look at go first
+        labels = self.store.mailboxes()
+        self.pool.put(self.service)
+        self.executor = ThreadPoolExecutor(self.pool.size)
+        try:
+            synced = dict(zip(labels, self.executor.map(self.sync_mailbox, labels)))
+        except CancelledError:
+            #stop() was called
+            return
+        self.executor.shutdown()
+        self.service = self.pool.get()
+        self.store.train_dictionary()
+        self.syncs = {}
+        for label in self.idle_labels:
+            if synced.get(label):
+                self.syncs[label] = MailboxSync(self.service, self.store, label, self.events)
+                #Listens on its own connection; changes come back through self.jobs
+                IdleListener(label, self.syncs[label].get_config("last_uid"),
+                             self.push_changes, self.syncs[label].get_config("modseq"),
+                             config).start()
+        while True:
+            job, args = self.jobs.get()
+            try:
+                try:
+                    job(*args)
+                except (OSError, imaplib.IMAP4.abort):
+                    #The server may have dropped the connection while it sat idle
+                    self.service.reconnect()
+                    job(*args)
+            except SyncStopped:
+                return
+            except SystemExit:
+                self.events.put(("failed", args[0]))
+
+    def stop(self):
+        #Called when the app closes. The executor's threads would otherwise
+        #keep the process alive until every running sync finished; instead,
+        #running downloads stop before their next chunk, and mailboxes not
+        #started yet are skipped
+        STOP_SYNCING.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def sync_mailbox(self, label):
+        #Runs on a pool thread; returns whether the mailbox synced
+        if STOP_SYNCING.is_set():
+            return False
+        store = Store("mail.db", self.service.config)
+        sync = MailboxSync(self.pool.get(), store, label, self.events, self.pool)
+        self.events.put(("syncing", label))
+        try:
+            sync.sync()
+        except SyncStopped:
+            return False
+        except (OSError, imaplib.IMAP4.abort):
+            #Only this mailbox's sync stops; the next user of the slot reconnects
+            sync.service = MailService(self.service.config)
+            self.events.put(("failed", label))
+            return False
+        except SystemExit:
+            #MailService exits on errors
+            self.events.put(("failed", label))
+            return False
+        except Exception as e:
+            #e.g. sqlite3.Error; the other mailboxes still sync, and the
+            #connection may be mid-response, so the next user reconnects
+            print("Error: couldn't sync", label + ":", repr(e))
+            sync.service = MailService(self.service.config)
+            self.events.put(("failed", label))
+            return False
+        finally:
+            store.close()
+            self.pool.put(sync.service)
+        self.events.put(("synced", label))
+        return True
+
+    def push_changes(self, label, new_uids, expunged):
+        #Called on an IdleListener's thread; db writes happen on this one
+        self.jobs.put((self.apply_pushed, (label, new_uids, expunged)))
+
+    def apply_pushed(self, label, new_uids, expunged):
+        self.syncs[label].apply_pushed(new_uids, expunged)
+
+class Prefetcher:
+    """Purpose: Downloads and renders the bodies of threads the user is likely
+        to open next (see MailboxController.prefetch()), on one background
+        thread with its own IMAP connection and db handle"""
+    def __init__(self, config=None):
+        #Passed to MailService; read from config.json if None
+        self.config = config
+        #Both are made on the executor's thread, the first time it's used
+        self.executor = ThreadPoolExecutor(1, initializer=self.connect)
+
+    def connect(self):
+        self.service = MailService(self.config)
+        self.store = Store("mail.db", self.service.config)
+
+    def submit(self, label, thread_ids, peek=True):
+        #Returns a Future that's done once the threads need no downloading
+        #or rendering to be shown. Unless peek, downloaded messages are
+        #marked read, as for a thread being opened
+        return self.executor.submit(self.prefetch, label, thread_ids, peek)
+
+    def prefetch(self, label, thread_ids, peek=True):
+        rows = self.store.db.execute("SELECT id, uid, type, bodies.dict, bodies.data, version"
+                                     + " FROM messages LEFT JOIN bodies USING (id)"
+                                     + " LEFT JOIN rendered USING (id) WHERE thread_id IN"
+                                     + f" ({','.join('?'*len(thread_ids))})", thread_ids).fetchall()
+        missing = {uid: id_ for id_, uid, type_, dict_id, data, version in rows if data is None}
+        bodies = {}
+        if missing:
+            try:
+                #Messages only nearby the opened thread aren't marked read
+                fetched = self.service.fetch_bodies(label, list(missing), peek)
+            except (OSError, imaplib.IMAP4.abort, SystemExit):
+                #Left for when the thread is (next) opened
+                self.service = MailService(self.service.config)
+                fetched = {}
+            except imaplib.IMAP4.error as e:
+                #e.g. a BAD reply; the connection itself is still usable
+                print("Error: couldn't download messages:", e)
+                fetched = {}
+            for uid, (type_, text) in fetched.items():
+                self.store.add_body(missing[uid], type_, text)
+                bodies[missing[uid]] = (type_, text)
+        for id_, uid, type_, dict_id, data, version in rows:
+            if data is None:
+                if id_ not in bodies:
+                    continue
+                type_, text = bodies[id_]
+            else:
+                text = self.store.body_text(dict_id, data)
+            if type_ == "html" and version != RENDERER_VERSION:
+                self.store.add_rendered(id_, RENDERER_VERSION, *render_html(text))
+        self.store.commit()
@@ -0,0 +1,92 @@
+import re
+
+#A <message id> in a Message-ID, In-Reply-To or References header
+MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+def message_ids(header):
+    return MESSAGE_ID.findall(header or "")
+
+def thread_msgs(db_cursor, label, msgs):
+    #Adds (id, date, subject, message id, references) messages to the threads
+    #of label, newest last. A message joins every thread that contains it or
+    #one of its references, merging them if there are several
+    for id_, date, subject, message_id, refs in msgs:
+        ids = list(dict.fromkeys(message_ids(refs) + message_ids(message_id)))
+        found = sorted({thread_id for (thread_id,) in db_cursor.execute(
+            f"SELECT thread_id FROM thread_ids WHERE label = ? AND message_id IN"
+            + f" ({','.join('?'*len(ids))})", [label] + ids)})
+        if found:
+            thread_id = found[0]
+            for other in found[1:]:
+                merge_threads(db_cursor, thread_id, other)
+        else:
+            db_cursor.execute("INSERT INTO threads (label, date, started, subject, msg_amt)"
+                              + " VALUES (?,?,?,?,0)", (label, date, date, subject))
+            thread_id = db_cursor.lastrowid
+        db_cursor.executemany("INSERT OR IGNORE INTO thread_ids VALUES (?,?,?)",
+                              ((label, message_id, thread_id) for message_id in ids))
+        db_cursor.execute("UPDATE messages SET thread_id = ? WHERE id = ?", (thread_id, id_))
+        db_cursor.execute("UPDATE threads SET msg_amt = msg_amt + 1, date = MAX(date, ?),"
+                          + " subject = CASE WHEN ? < started THEN ? ELSE subject END,"
+                          + " started = MIN(started, ?) WHERE id = ?",
+                          (date, date, subject, date, thread_id))
+
+def merge_threads(db_cursor, thread_id, other):
+    #Moves everything in thread other into thread_id
+    db_cursor.execute("UPDATE messages SET thread_id = ? WHERE thread_id = ?", (thread_id, other))
+    db_cursor.execute("UPDATE thread_ids SET thread_id = ? WHERE thread_id = ?",
+                      (thread_id, other))
+    (date, started, subject, msg_amt) = db_cursor.execute(
+        "SELECT date, started, subject, msg_amt FROM threads WHERE id = ?", (other,)).fetchone()
+    db_cursor.execute("UPDATE threads SET msg_amt = msg_amt + ?, date = MAX(date, ?),"
+                      + " subject = CASE WHEN ? < started THEN ? ELSE subject END,"
+                      + " started = MIN(started, ?) WHERE id = ?",
+                      (msg_amt, date, started, subject, started, thread_id))
+    db_cursor.execute("DELETE FROM threads WHERE id = ?", (other,))
+
+def rethread(db_cursor):
+    #Rebuilds every thread from the messages' stored headers. Does what
+    #thread_msgs() would for each message, but in memory with a union-find
+    #over message ids, then writes the result in bulk
+    db_cursor.execute("DELETE FROM threads")
+    db_cursor.execute("DELETE FROM thread_ids")
+    msgs = db_cursor.execute("SELECT label, id, date, subject, message_id, refs"
+                             + " FROM messages ORDER BY label, date").fetchall()
+    parents = {}
+    def find(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+    msg_keys = []
+    for label, id_, date, subject, message_id, refs in msgs:
+        #A message without ids is keyed by its row id, so it's on its own
+        keys = [(label, message_id) for message_id in
+                dict.fromkeys(MESSAGE_ID.findall(f"{refs} {message_id}"))] or [(label, id_)]
+        root = find(parents.setdefault(keys[0], keys[0]))
+        for key in keys[1:]:
+            parents[find(parents.setdefault(key, key))] = root
+        msg_keys.append(keys[0])
+    #[id, label, date, started, subject, msg_amt] by root key; messages are
+    #oldest first, so a thread's first message gives its subject
+    threads = {}
+    thread_ids = []
+    for (label, id_, date, subject, message_id, refs), key in zip(msgs, msg_keys):
+        thread = threads.get(find(key))
+        if thread is None:
+            thread = threads[find(key)] = [len(threads) + 1, label, date, date, subject, 0]
+        thread[2] = max(thread[2], date)
+        thread[5] += 1
+        thread_ids.append((id_, thread[0]))
+    db_cursor.executemany("INSERT INTO threads VALUES (?,?,?,?,?,?)", threads.values())
+    #Inserted in primary key order, which sqlite does much faster
+    db_cursor.executemany("INSERT INTO thread_ids VALUES (?,?,?)",
+                          ((label, message_id, threads[find((label, message_id))][0])
+                           for label, message_id in sorted(key for key in parents
+                                                           if isinstance(key[1], str))))
+    #Much faster than an UPDATE per message
+    db_cursor.execute("CREATE TEMP TABLE message_threads (id INTEGER PRIMARY KEY, thread_id INT)")
+    db_cursor.executemany("INSERT INTO temp.message_threads VALUES (?,?)", thread_ids)
+    db_cursor.execute("UPDATE messages SET thread_id = message_threads.thread_id"
+                      + " FROM temp.message_threads WHERE messages.id = message_threads.id")
+    db_cursor.execute("DROP TABLE temp.message_threads")
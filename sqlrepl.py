@@ -1,6 +1,10 @@
-import sqlite3
+import sqlite3, sys
+sys.path.append("services")
+from store import *
 
-db = sqlite3.connect('mail.db')
+#Store registers the functions the db's triggers need (e.g. body_text)
+store = Store('mail.db', {})
+db = store.db
 cursor = db.cursor()
 
 print("db: The database", "cursor: The db cursor", sep='\n')